@@ -0,0 +1,127 @@
+import asyncio
+import contextlib
+import functools
+import queue
+import threading
+
+import classes.database as database
+
+# Awaitable counterpart of classes.database. All queries are handed to one worker
+# thread, so a slow query never blocks the event loop.
+
+
+class _DatabaseWorker():
+    def __init__(self) -> None:
+        self._requests: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: threading.Thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs) -> asyncio.Future:
+        """Queues func to be run on the worker thread and returns a future for its result."""
+        self._ensure_started()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._requests.put((loop, future, func, args, kwargs))
+        return future
+
+    def stop(self) -> None:
+        """Stops the worker thread after the queued requests are done."""
+        with self._lock:
+            if self._thread is None:
+                return
+            self._requests.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="database-worker", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            loop, future, func, args, kwargs = request
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as e:
+                loop.call_soon_threadsafe(_set_exception, future, e)
+            else:
+                loop.call_soon_threadsafe(_set_result, future, result)
+
+
+def _set_result(future: asyncio.Future, result) -> None:
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, exception: BaseException) -> None:
+    if not future.done():
+        future.set_exception(exception)
+
+
+_worker = _DatabaseWorker()
+
+
+def _awaitable(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await _worker.submit(func, *args, **kwargs)
+    return wrapper
+
+
+async def run(func, *args, **kwargs):
+    """Runs any function of classes.database (or one using it) on the database thread."""
+    return await _worker.submit(func, *args, **kwargs)
+
+
+# setup runs before the event loop exists, so it stays synchronous.
+setup = database.setup
+
+
+def shutdown() -> None:
+    """Stops the database thread and closes all connections."""
+    _worker.stop()
+    database.close_connections()
+
+
+@contextlib.asynccontextmanager
+async def transaction(batch: database.Transaction = None):
+    """Yields a Transaction that is executed on the database thread when the block is
+    left without an error.
+    If an existing transaction is given, it's yielded instead and left to its owner."""
+    if batch is not None:
+        yield batch
+        return
+    batch = database.Transaction()
+    yield batch
+    if len(batch) > 0:
+        await run(database.execute_transaction, batch)
+
+
+allocate_id = _awaitable(database.allocate_id)
+get_data = _awaitable(database.get_data)
+save_data = _awaitable(database.save_data)
+delete_data = _awaitable(database.delete_data)
+update_data = _awaitable(database.update_data)
+get_shop_data = _awaitable(database.get_shop_data)
+get_shops_data = _awaitable(database.get_shops_data)
+get_shop_owners = _awaitable(database.get_shop_owners)
+get_user_shops = _awaitable(database.get_user_shops)
+increase_shop_count = _awaitable(database.increase_shop_count)
+decrease_shop_count = _awaitable(database.decrease_shop_count)
+get_counts = _awaitable(database.get_counts)
+search_shops = _awaitable(database.search_shops)
+get_adjacent_shop_id = _awaitable(database.get_adjacent_shop_id)
+count_shops = _awaitable(database.count_shops)
+get_due = _awaitable(database.get_due)
+get_upcoming = _awaitable(database.get_upcoming)
+record_failed_expiry = _awaitable(database.record_failed_expiry)
+get_failed_expiries = _awaitable(database.get_failed_expiries)
+clear_failed_expiries = _awaitable(database.clear_failed_expiries)
+get_voting_data = _awaitable(database.get_voting_data)
+get_votings_data = _awaitable(database.get_votings_data)
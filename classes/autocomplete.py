@@ -0,0 +1,207 @@
+import asyncio
+import bisect
+import threading
+from collections import defaultdict
+
+import interactions as i
+
+import classes.async_database as db
+import classes.database as database
+
+# In-memory indexes for the id autocompletion of shops, offers and votings. A keystroke
+# only searches the index; rows written since the last search are reloaded (with one
+# query) on the next one. Only writes that don't say which rows they changed rebuild
+# the whole index.
+
+
+class PrefixIndex():
+    def __init__(self) -> None:
+        """Finds entries by a prefix of their id or of a word of their name."""
+        self._keys: list[tuple[str, int]] = []
+        self._entries: dict[int, tuple[str, frozenset, dict]] = {}
+
+    def add(self, id: int, name: str, owners: set[int] = frozenset(), **attributes) -> None:
+        """Adds the entry, replacing an existing one with the same id.
+        The attributes can be used to filter searches."""
+        self.remove(id)
+        self._entries[id] = (name, frozenset(owners), attributes)
+        for key in self._get_keys(id, name):
+            bisect.insort(self._keys, (key, id))
+
+    @classmethod
+    def build(cls, entries: list[tuple]) -> "PrefixIndex":
+        """Returns a new index of the (id, name, owners, attributes) entries. The keys are
+        sorted once at the end instead of being inserted one by one."""
+        index = cls()
+        for id, name, owners, attributes in entries:
+            index._entries[id] = (name, frozenset(owners), attributes)
+            index._keys.extend((key, id) for key in cls._get_keys(id, name))
+        index._keys.sort()
+        return index
+
+    def remove(self, id: int) -> None:
+        """Removes the entry if it exists."""
+        entry = self._entries.pop(id, None)
+        if entry is None:
+            return
+        for key in self._get_keys(id, entry[0]):
+            index = bisect.bisect_left(self._keys, (key, id))
+            if index < len(self._keys) and self._keys[index] == (key, id):
+                del self._keys[index]
+
+    def search(self, prefix: str, owner: int = None, limit: int = 25, **attributes) -> list[tuple[int, str]]:
+        """Returns up to limit (id, name) pairs whose id or a word of their name starts with
+        the prefix. If owner is given, only entries owned by them are returned, and only
+        entries with the given attribute values."""
+        prefix = prefix.strip().lower()
+        candidates = iter(self._entries) if prefix == "" else self._matches(prefix)
+        results = []
+        seen = set()
+        for id in candidates:
+            if id in seen:
+                continue
+            seen.add(id)
+            name, owners, entry_attributes = self._entries[id]
+            if owner is not None and owner not in owners:
+                continue
+            if any(entry_attributes.get(key) != value for key, value in attributes.items()):
+                continue
+            results.append((id, name))
+            if len(results) >= limit:
+                break
+        return results
+
+    def _matches(self, prefix: str):
+        """Yields the ids of all keys starting with the prefix, in key order."""
+        index = bisect.bisect_left(self._keys, (prefix, -1))
+        while index < len(self._keys) and self._keys[index][0].startswith(prefix):
+            yield self._keys[index][1]
+            index += 1
+
+    @staticmethod
+    def _get_keys(id: int, name: str) -> set[str]:
+        name = str(name or "").lower()
+        return {str(id), name} | set(name.split())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def _load_shops(ids: list[int] = None) -> list[tuple]:
+    conditions = {} if ids is None else {"shop_id": ids}
+    owners = defaultdict(set)
+    for shop_id, user_id in database.get_data("shop_owners", conditions, attribute="shop_id, user_id",
+                                              fetch_all=True):
+        owners[shop_id].add(int(user_id))
+    shops = database.get_data("shops", conditions, attribute="shop_id, name, approved, obligatory",
+                              fetch_all=True)
+    return [(shop_id, name, owners[shop_id], {"approved": bool(approved), "obligatory": bool(obligatory)})
+            for shop_id, name, approved, obligatory in shops]
+
+
+def _load_offers(ids: list[int] = None) -> list[tuple]:
+    offers = database.get_data(
+        "offers", {} if ids is None else {"offer_id": ids}, attribute="offer_id, title, user_id",
+        fetch_all=True)
+    return [(offer_id, title, {int(user_id)}, {}) for offer_id, title, user_id in offers]
+
+
+def _load_votings(ids: list[int] = None) -> list[tuple]:
+    votings = database.get_data(
+        "votings", {} if ids is None else {"voting_id": ids}, attribute="voting_id, description, user_id",
+        fetch_all=True)
+    return [(voting_id, description, {int(user_id)}, {}) for voting_id, description, user_id in votings]
+
+
+class _TableIndex():
+    def __init__(self, loader, tables: set[str]) -> None:
+        self.loader = loader
+        self.tables = tables
+        self.index = PrefixIndex()
+        self.stale = True
+        # The ids of the rows written since the last search
+        self.changed: set[int] = set()
+        # The writes are reported on the database thread
+        self.changed_lock = threading.Lock()
+        self.lock = asyncio.Lock()
+
+    def mark_changed(self, ids: set[int] | None) -> None:
+        """Marks the rows for reloading, or the whole index if ids is None."""
+        with self.changed_lock:
+            if ids is None:
+                self.stale = True
+            else:
+                self.changed |= ids
+
+    async def get(self) -> PrefixIndex:
+        async with self.lock:
+            # Reset first, so a write during the reload marks it again
+            with self.changed_lock:
+                stale, changed = self.stale, self.changed
+                self.stale, self.changed = False, set()
+            try:
+                if stale:
+                    self.index = PrefixIndex.build(await db.run(self.loader))
+                elif len(changed) > 0:
+                    # Deleted rows aren't loaded anymore, so everything changed goes first
+                    for id in changed:
+                        self.index.remove(id)
+                    for id, name, owners, attributes in await db.run(self.loader, list(changed)):
+                        self.index.add(id, name, owners, **attributes)
+            except BaseException:
+                self.mark_changed(None)
+                raise
+        return self.index
+
+
+_indexes = {
+    "shops": _TableIndex(_load_shops, {"shops", "shop_owners"}),
+    "offers": _TableIndex(_load_offers, {"offers"}),
+    "votings": _TableIndex(_load_votings, {"votings"}),
+}
+
+
+def _on_write(changes: dict[str, set[int] | None]) -> None:
+    for table_index in _indexes.values():
+        for table, ids in changes.items():
+            if table in table_index.tables:
+                table_index.mark_changed(ids)
+
+
+database.add_write_listener(_on_write)
+
+
+async def search(table: str, prefix: str, owner: int = None, **attributes) -> list[tuple[int, str]]:
+    """Returns up to 25 (id, name) pairs of the table ("shops", "offers" or "votings")
+    matching the prefix, see PrefixIndex.search."""
+    index = await _indexes[table].get()
+    return index.search(prefix, owner=owner, **attributes)
+
+
+async def send_choices(ctx: i.AutocompleteContext, table: str, owner: int = None, **attributes) -> None:
+    """Answers the autocompletion with the matching entries of the table."""
+    results = await search(table, ctx.input_text or "", owner=owner, **attributes)
+    choices = []
+    for id, name in results:
+        name = " ".join(str(name or "").split())
+        choices.append({"name": f"{id} - {name}"[:100], "value": str(id)})
+    await ctx.send(choices=choices)
+
+
+async def send_select_menu(ctx: i.InteractionContext, custom_id: str, options: list[i.StringSelectOption],
+                           placeholder: str, multiple: bool = False, content: str = None,
+                           delete_after: int = 25) -> None:
+    """Sends a select menu with the first 25 options. If there are more, it points to the
+    id option (with autocompletion) instead of sending more menus."""
+    shown = options[:25]
+    if len(options) > 25:
+        hint = "Es werden nur die ersten 25 angezeigt. Nutze die Option `id`, um alle zu durchsuchen."
+        content = f"{content}\n{hint}" if content else hint
+    menu = i.StringSelectMenu(
+        *shown,
+        custom_id=custom_id,
+        placeholder=placeholder,
+        min_values=1,
+        max_values=len(shown) if multiple else 1
+    )
+    await ctx.send(content=content, components=menu, ephemeral=True, delete_after=delete_after)
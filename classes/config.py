@@ -0,0 +1,19 @@
+import configparser as cp
+import os
+
+# Parsed config files by path, with the modification time they were read at
+_configs: dict[str, tuple[float, cp.ConfigParser]] = {}
+
+
+def get_config(file: str = 'config.ini') -> cp.ConfigParser:
+    """Returns the parsed config file. It's only read again after it was changed,
+    so this can be called for every object that needs a config value."""
+    mtime = os.stat(file).st_mtime
+    cached = _configs.get(file)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    config = cp.ConfigParser()
+    with open(file, 'r') as config_file:
+        config.read_file(config_file)
+    _configs[file] = (mtime, config)
+    return config
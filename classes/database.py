@@ -1,137 +1,660 @@
+import contextlib
+import functools
 import sqlite3 as sql
+import threading
+from collections import defaultdict
 
 # Beware: All of this is not sufficient to stop SQL injection, but enough for this bot
 # It's also pretty bad code, but it works. I'm sorry.
 
+DATABASE_FILE = "data.db"
+
+# Every thread gets its own long-lived connection; opening one per query was the
+# most expensive part of most queries.
+_local = threading.local()
+_connections: list[sql.Connection] = []
+_connections_lock = threading.Lock()
+# Increased by close_connections, a thread whose connection is from an older generation
+# opens a new one
+_generation = 0
+_write_listeners: list = []
+# The id column of the tables whose write listeners are told which rows changed
+_ROW_ID_COLUMNS = {"shops": "shop_id", "shop_owners": "shop_id", "offers": "offer_id", "votings": "voting_id"}
+
+
+def get_connection() -> sql.Connection:
+    """Returns the connection of the current thread. It's opened and tuned on first use
+    and kept open afterwards."""
+    con = getattr(_local, "connection", None)
+    if con is None or getattr(_local, "generation", None) != _generation:
+        con = sql.connect(DATABASE_FILE, check_same_thread=False,
+                          cached_statements=256)
+        con.execute("PRAGMA journal_mode = WAL")
+        con.execute("PRAGMA synchronous = NORMAL")
+        con.execute("PRAGMA cache_size = -16000")  # 16 MB
+        con.execute("PRAGMA mmap_size = 268435456")  # 256 MB
+        con.execute("PRAGMA temp_store = MEMORY")
+        _local.connection = con
+        _local.generation = _generation
+        with _connections_lock:
+            _connections.append(con)
+    return con
+
+
+def close_connections() -> None:
+    """Closes all connections opened by get_connection. Every thread opens a new one on
+    its next query."""
+    global _generation
+    with _connections_lock:
+        _generation += 1
+        for con in _connections:
+            con.close()
+        _connections.clear()
+    _local.__dict__.clear()
+
+
+def _migrate_shop_owners(con: sql.Connection) -> None:
+    con.execute("CREATE TABLE shop_owners (shop_id INTEGER NOT NULL, user_id BIGINT NOT NULL,\
+                PRIMARY KEY (shop_id, user_id), FOREIGN KEY(shop_id) REFERENCES shops(shop_id),\
+                FOREIGN KEY(user_id) REFERENCES users(user_id))")
+    con.execute("CREATE INDEX shop_owners_user_id ON shop_owners (user_id)")
+    shops = con.execute(
+        "SELECT shop_id, owners FROM shops WHERE owners IS NOT NULL").fetchall()
+    con.executemany("INSERT OR IGNORE INTO shop_owners (shop_id, user_id) VALUES (?, ?)",
+                    [(shop_id, int(owner)) for shop_id, owners in shops
+                     for owner in str(owners).split(",") if owner.strip() != ""])
+
+
+# Every migration brings the schema from its position in the list to the next version,
+# which is tracked with PRAGMA user_version. Never change a released migration, add a
+# new one at the end instead. A migration is either a sql script or a function that
+# gets the connection.
+_MIGRATIONS: list = [
+    # 1: The initial schema (IF NOT EXISTS, because it predates the versioning)
+    """
+    CREATE TABLE IF NOT EXISTS offers (offer_id INTEGER PRIMARY KEY, user_id BIGINT,
+        title TEXT, message_id BIGINT, deadline FLOAT,
+        description TEXT, price TEXT, FOREIGN KEY(user_id) REFERENCES users(user_id));
+    CREATE TABLE IF NOT EXISTS users (user_id BIGINT PRIMARY KEY,
+        offers_count INTEGER, shop_count INTEGER);
+    CREATE TABLE IF NOT EXISTS votings (voting_id INTEGER PRIMARY KEY,
+        user_id BIGINT, message_id BIGINT, deadline FLOAT,
+        description TEXT, wait_time FLOAT, create_time FLOAT,
+        time_type TEXT, initial_deadline FLOAT, count INTEGER,
+        FOREIGN KEY(user_id) REFERENCES users(user_id));
+    CREATE TABLE IF NOT EXISTS shops (shop_id INTEGER PRIMARY KEY,
+        owners TEXT, name TEXT, offer TEXT, location TEXT,
+        category TEXT, approved BOOLEAN, message_id BIGINT, obligatory BOOLEAN);
+    CREATE TABLE IF NOT EXISTS vacations (ID INTEGER PRIMARY KEY,
+        user_id BIGINT, start_date BIGINT, end_date BIGINT, reason TEXT,
+        issuer BIGINT, message_id BIGINT);
+    """,
+    # 2: Indexes for the lookups the bot does all the time
+    """
+    CREATE INDEX IF NOT EXISTS offers_user_id ON offers (user_id);
+    CREATE INDEX IF NOT EXISTS offers_deadline ON offers (deadline);
+    CREATE INDEX IF NOT EXISTS votings_user_id ON votings (user_id);
+    CREATE INDEX IF NOT EXISTS votings_deadline ON votings (deadline);
+    CREATE INDEX IF NOT EXISTS shops_approved_category ON shops (approved, category);
+    CREATE INDEX IF NOT EXISTS shops_category ON shops (category);
+    CREATE INDEX IF NOT EXISTS shops_obligatory ON shops (obligatory);
+    CREATE INDEX IF NOT EXISTS vacations_end_date ON vacations (end_date);
+    """,
+    # 3: Shop owners get their own table instead of shops.owners (which is no longer used)
+    _migrate_shop_owners,
+    # 4: Keep users.offers_count up to date in the database and fix the counts that drifted
+    """
+    CREATE TRIGGER offers_count_insert AFTER INSERT ON offers BEGIN
+        INSERT OR IGNORE INTO users (user_id, offers_count, shop_count) VALUES (NEW.user_id, 0, 0);
+        UPDATE users SET offers_count = COALESCE(offers_count, 0) + 1 WHERE user_id = NEW.user_id;
+    END;
+    CREATE TRIGGER offers_count_delete AFTER DELETE ON offers BEGIN
+        UPDATE users SET offers_count = MAX(COALESCE(offers_count, 0) - 1, 0)
+            WHERE user_id = OLD.user_id;
+    END;
+    UPDATE users SET offers_count = (SELECT COUNT(*) FROM offers WHERE offers.user_id = users.user_id);
+    """,
+    # 5: The next id to hand out per table, see allocate_id
+    """
+    CREATE TABLE id_sequences (name TEXT PRIMARY KEY, next_id INTEGER NOT NULL);
+    """,
+    # 6: Full text index over the shops, kept in sync by triggers
+    """
+    CREATE VIRTUAL TABLE shops_fts USING fts5(name, offer, location,
+        content='shops', content_rowid='shop_id');
+    CREATE TRIGGER shops_fts_insert AFTER INSERT ON shops BEGIN
+        INSERT INTO shops_fts (rowid, name, offer, location)
+            VALUES (NEW.shop_id, NEW.name, NEW.offer, NEW.location);
+    END;
+    CREATE TRIGGER shops_fts_delete AFTER DELETE ON shops BEGIN
+        INSERT INTO shops_fts (shops_fts, rowid, name, offer, location)
+            VALUES ('delete', OLD.shop_id, OLD.name, OLD.offer, OLD.location);
+    END;
+    CREATE TRIGGER shops_fts_update AFTER UPDATE OF shop_id, name, offer, location ON shops BEGIN
+        INSERT INTO shops_fts (shops_fts, rowid, name, offer, location)
+            VALUES ('delete', OLD.shop_id, OLD.name, OLD.offer, OLD.location);
+        INSERT INTO shops_fts (rowid, name, offer, location)
+            VALUES (NEW.shop_id, NEW.name, NEW.offer, NEW.location);
+    END;
+    INSERT INTO shops_fts (shops_fts) VALUES ('rebuild');
+    """,
+    # 7: Items whose expiry failed, to retry them
+    """
+    CREATE TABLE failed_expiries (kind TEXT, item_id INTEGER, attempts INTEGER,
+        last_error TEXT, failed_at FLOAT, PRIMARY KEY (kind, item_id));
+    """,
+    # 8: The tie-break voting of a voting that is being closed, so it's only posted once
+    """
+    ALTER TABLE votings ADD COLUMN tie_break_id INTEGER;
+    """,
+]
+
 
 def setup(file: str = "data.db"):
-    with sql.connect(file) as conn:
-        c = conn.cursor()
-        c.execute(
-            "CREATE TABLE IF NOT EXISTS offers (offer_id INTEGER PRIMARY KEY, user_id BIGINT,\
-            title TEXT, message_id BIGINT, deadline FLOAT,\
-            description TEXT, price TEXT, FOREIGN KEY(user_id) REFERENCES users(user_id))")
-        c.execute("CREATE TABLE IF NOT EXISTS users (user_id BIGINT PRIMARY KEY,\
-            offers_count INTEGER, shop_count INTEGER)")
-        c.execute("CREATE TABLE IF NOT EXISTS votings (voting_id INTEGER PRIMARY KEY,\
-                  user_id BIGINT, message_id BIGINT, deadline FLOAT,\
-                  description TEXT, wait_time FLOAT, create_time FLOAT,\
-                  time_type TEXT, initial_deadline FLOAT, count INTEGER,\
-                  FOREIGN KEY(user_id) REFERENCES users(user_id))")
-        c.execute("CREATE TABLE IF NOT EXISTS shops (shop_id INTEGER PRIMARY KEY,\
-                  owners TEXT, name TEXT, offer TEXT, location TEXT,\
-                  category TEXT, approved BOOLEAN, message_id BIGINT, obligatory BOOLEAN)")
-        c.execute("CREATE TABLE IF NOT EXISTS vacations (ID INTEGER PRIMARY KEY,\
-                  user_id BIGINT, start_date BIGINT, end_date BIGINT, reason TEXT,\
-                  issuer BIGINT, message_id BIGINT)")
-        conn.commit()
+    """Opens the database and brings its schema up to date."""
+    global DATABASE_FILE
+    if file != DATABASE_FILE:
+        close_connections()
+        DATABASE_FILE = file
+    migrate(get_connection())
 
 
-def get_data(table: str, *conditions: dict, attribute: str = '*', fetch_all: bool = False) -> list[tuple] | tuple | None:
-    """Returns data from the database. If fetch_all is True, it returns a list of tuples,
-    else a single tuple or None if no entry is found."""
-    with sql.connect("data.db") as con:
-        cur = con.cursor()
-        attribute = attribute.replace(';', '')
-        table = table.replace(';', '')
-        if len(conditions) == 0:
-            cur.execute(f"SELECT {attribute} FROM {table}")
+def migrate(con: sql.Connection) -> None:
+    """Applies all migrations the database doesn't have yet, each in its own transaction."""
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    if version > len(_MIGRATIONS):
+        raise RuntimeError(
+            f"The database has version {version}, but this bot only knows {len(_MIGRATIONS)}.")
+    for number, migration in enumerate(_MIGRATIONS[version:], start=version + 1):
+        try:
+            if callable(migration):
+                con.execute("BEGIN")
+                migration(con)
+                con.execute(f"PRAGMA user_version = {number}")
+                con.commit()
+            else:
+                con.executescript(
+                    f"BEGIN;\n{migration}\nPRAGMA user_version = {number};\nCOMMIT;")
+        except sql.Error:
+            if con.in_transaction:
+                con.rollback()
+            raise
+
+
+def _condition_shape(conditions: dict) -> tuple:
+    """Returns the shape of the conditions: the column names and, for list values,
+    the number of values. Conditions with the same shape share one statement."""
+    return tuple((attr, len(value) if type(value) is list else None)
+                 for attr, value in conditions.items())
+
+
+def _condition_values(conditions: dict) -> tuple:
+    """Returns the values of the conditions in the order of their placeholders."""
+    values = []
+    for value in conditions.values():
+        if type(value) is list:
+            values.extend(value)
+        else:
+            values.append(value)
+    return tuple(values)
+
+
+def _where_clause(shape: tuple) -> str:
+    if len(shape) == 0:
+        return ""
+    parts = []
+    for attr, count in shape:
+        if count is None:
+            parts.append(f"{attr} = ?")
+        elif count == 0:
+            # IN () is not valid sql, and nothing can match an empty list anyway
+            parts.append("0")
         else:
-            conditions = conditions[0]
-            statement = f"SELECT {attribute} FROM {table} WHERE "
-            delete_attr = []
-            for attr in conditions:
-                if type(conditions[attr]) is list:
-                    # This is bad. To avoid serious injury, stop looking at this.
-                    statement += f"{attr} IN ("
-                    for value in conditions[attr]:
-                        statement += f"""'{value}', """
-                    statement = statement[:-2]
-                    statement += ") AND "
-                    delete_attr.append(attr)
-                else:
-                    statement += f"{attr} = ? AND "
-            for attr in delete_attr:
-                del conditions[attr]
-            statement = statement[:-5]
-            cur.execute(statement, tuple(conditions.values()))
-        if fetch_all:
-            return cur.fetchall()
-        return cur.fetchone()
-
-
-def save_data(table: str, attributes: str, values: tuple) -> None:
-    """Saves data to the database."""
+            parts.append(f"{attr} IN ({', '.join('?' * count)})")
+    return " WHERE " + " AND ".join(parts)
+
+
+# The statements are cached by their shape, so the same query always produces the
+# same sql string and sqlite can reuse the prepared statement.
+@functools.lru_cache(maxsize=512)
+def _select_statement(table: str, attribute: str, shape: tuple) -> str:
+    table = table.replace(';', '')
+    attribute = attribute.replace(';', '')
+    return f"SELECT {attribute} FROM {table}{_where_clause(shape)}"
+
+
+@functools.lru_cache(maxsize=128)
+def _insert_statement(table: str, attributes: str, count: int) -> str:
     table = table.replace(';', '')
     attributes = attributes.replace(';', '')
-    with sql.connect("data.db") as con:
-        cur = con.cursor()
-        statement = f"INSERT INTO {table} ({attributes}) VALUES ( "
-        for _ in values:
-            statement += "?, "
-        statement = statement[:-2] + ")"
-        cur.execute(statement, values)
-        con.commit()
+    return f"INSERT INTO {table} ({attributes}) VALUES ({', '.join('?' * count)})"
+
+
+@functools.lru_cache(maxsize=128)
+def _delete_statement(table: str, shape: tuple) -> str:
+    table = table.replace(';', '')
+    return f"DELETE FROM {table}{_where_clause(shape)}"
+
+
+@functools.lru_cache(maxsize=128)
+def _update_fields_statement(table: str, attributes: tuple, shape: tuple) -> str:
+    table = table.replace(';', '')
+    assignments = ", ".join(f"{attr.replace(';', '')} = ?" for attr in attributes)
+    return f"UPDATE {table} SET {assignments}{_where_clause(shape)}"
+
+
+@functools.lru_cache(maxsize=128)
+def _upsert_statement(table: str, key: str, attributes: tuple) -> str:
+    table = table.replace(';', '')
+    key = key.replace(';', '')
+    attributes = tuple(attr.replace(';', '') for attr in attributes)
+    assignments = ", ".join(
+        f"{attr} = excluded.{attr}" for attr in attributes if attr != key)
+    return (f"INSERT INTO {table} ({', '.join(attributes)}) VALUES ({', '.join('?' * len(attributes))})"
+            f" ON CONFLICT({key}) DO UPDATE SET {assignments}")
+
+
+@functools.lru_cache(maxsize=128)
+def _increase_statement(table: str, attribute: str, shape: tuple) -> str:
+    table = table.replace(';', '')
+    attribute = attribute.replace(';', '')
+    return f"UPDATE {table} SET {attribute} = {attribute} + ?{_where_clause(shape)}"
+
+
+@functools.lru_cache(maxsize=128)
+def _update_statement(table: str, attribute: str, shape: tuple) -> str:
+    table = table.replace(';', '')
+    attribute = attribute.replace(';', '')
+    return f"UPDATE {table} SET {attribute} = ?{_where_clause(shape)}"
+
+
+def get_data(table: str, *conditions: dict, attribute: str = '*', fetch_all: bool = False) -> list[tuple] | tuple | None:
+    """Returns data from the database. If fetch_all is True, it returns a list of tuples,
+    else a single tuple or None if no entry is found.
+    List values in the conditions are matched with IN."""
+    conditions = conditions[0] if len(conditions) > 0 else {}
+    statement = _select_statement(
+        table, attribute, _condition_shape(conditions))
+    cur = get_connection().execute(statement, _condition_values(conditions))
+    if fetch_all:
+        return cur.fetchall()
+    return cur.fetchone()
+
+
+def add_write_listener(listener) -> None:
+    """Registers a function that's called after writes were committed, with a dict of the
+    written tables to the ids of the changed rows (see _ROW_ID_COLUMNS). The ids are None if
+    they aren't known, e.g. for a delete by user. It's called on the thread that wrote, so
+    it has to be quick."""
+    _write_listeners.append(listener)
+
+
+def _get_row_ids(table: str, columns: dict) -> set[int] | None:
+    """Returns the ids of the rows that the row values or conditions refer to, None if
+    they don't contain the id column."""
+    id_column = _ROW_ID_COLUMNS.get(table)
+    if id_column not in columns:
+        return None
+    value = columns[id_column]
+    return {int(id) for id in value} if type(value) is list else {int(value)}
+
+
+def _add_change(changes: dict, table: str, ids: set[int] | None) -> None:
+    if ids is None or changes.get(table, set()) is None:
+        changes[table] = None
+    else:
+        changes[table] = changes.get(table, set()) | ids
+
+
+def _get_columns(attributes: str, values: tuple) -> dict:
+    """Returns the values of an insert by attribute name."""
+    return dict(zip((attribute.strip() for attribute in attributes.split(",")), values))
+
+
+def _notify_write(changes: dict[str, set[int] | None]) -> None:
+    for listener in _write_listeners:
+        listener(changes)
+
+
+def save_data(table: str, attributes: str, values: tuple) -> int:
+    """Saves data to the database. Returns the rowid of the new row."""
+    statement = _insert_statement(table, attributes, len(values))
+    con = get_connection()
+    with con:
+        rowid = con.execute(statement, values).lastrowid
+    _notify_write({table: _get_row_ids(table, _get_columns(attributes, values))})
+    return rowid
 
 
 def delete_data(table: str, conditions: dict) -> None:
     """Deletes data from the database."""
-    table = table.replace(';', '')
-    with sql.connect("data.db") as con:
-        cur = con.cursor()
-        statement = f"DELETE FROM {table} WHERE "
-        for attr in conditions:
-            statement += f"{attr} = ? AND "
-        statement = statement[:-5]
-        cur.execute(statement, tuple(conditions.values()))
-        con.commit()
+    statement = _delete_statement(table, _condition_shape(conditions))
+    con = get_connection()
+    with con:
+        con.execute(statement, _condition_values(conditions))
+    _notify_write({table: _get_row_ids(table, conditions)})
 
 
 def update_data(table: str, attribute: str, value, conditions: dict) -> None:
     """Updates data in the database."""
-    table = table.replace(';', '')
-    attribute = attribute.replace(';', '')
-    with sql.connect("data.db") as con:
-        cur = con.cursor()
-        statement = f"UPDATE {table} SET {attribute} = ? WHERE "
-        for attr in conditions:
-            statement += f"{attr} = ? AND "
-        statement = statement[:-5]
-        value_tuple = (value,) + tuple(conditions.values())
-        cur.execute(statement, value_tuple)
-        con.commit()
+    statement = _update_statement(
+        table, attribute, _condition_shape(conditions))
+    con = get_connection()
+    with con:
+        con.execute(statement, (value,) + _condition_values(conditions))
+    _notify_write({table: _get_row_ids(table, conditions)})
+
+
+# The counters in users are only changed with single statements, so concurrent changes
+# can't overwrite each other. offers_count is kept up to date by triggers on offers.
+_INCREASE_SHOP_COUNT = "INSERT INTO users (user_id, offers_count, shop_count) VALUES (?, 0, 1)\
+    ON CONFLICT(user_id) DO UPDATE SET shop_count = COALESCE(shop_count, 0) + 1"
+_DECREASE_SHOP_COUNT = "UPDATE users SET shop_count = shop_count - 1\
+    WHERE user_id = ? AND shop_count > 0"
+
+
+class Transaction():
+    def __init__(self) -> None:
+        """
+        Collects writes to run them in a single transaction.
+        Nothing is written until it's executed, usually by leaving transaction().
+        Consecutive writes with the same statement are sent with one executemany.
+        """
+        self._operations: list[tuple[str, list[tuple]]] = []
+        self._changes: dict[str, set[int] | None] = {}
+
+    def save(self, table: str, attributes: str, values: tuple) -> None:
+        """Saves one row."""
+        self.save_many(table, attributes, [values])
+
+    def save_many(self, table: str, attributes: str, rows: list[tuple]) -> None:
+        """Saves multiple rows with the same attributes."""
+        for values in rows:
+            self._add(table, _insert_statement(table, attributes, len(values)), tuple(values),
+                      _get_row_ids(table, _get_columns(attributes, values)))
+
+    def delete(self, table: str, conditions: dict) -> None:
+        """Deletes the rows matching the conditions."""
+        self.delete_many(table, [conditions])
+
+    def delete_many(self, table: str, conditions: list[dict]) -> None:
+        """Deletes the rows matching any of the conditions."""
+        for condition in conditions:
+            self._add(table, _delete_statement(table, _condition_shape(condition)),
+                      _condition_values(condition), _get_row_ids(table, condition))
+
+    def update(self, table: str, attribute: str, value, conditions: dict) -> None:
+        """Sets the attribute of the rows matching the conditions."""
+        self.update_many(table, attribute, [(value, conditions)])
+
+    def update_many(self, table: str, attribute: str, rows: list[tuple]) -> None:
+        """Sets the attribute for multiple (value, conditions) pairs."""
+        for value, conditions in rows:
+            self._add(table, _update_statement(table, attribute, _condition_shape(conditions)),
+                      (value,) + _condition_values(conditions), _get_row_ids(table, conditions))
+
+    def update_fields(self, table: str, values: dict, conditions: dict) -> None:
+        """Sets multiple attributes of the rows matching the conditions in one statement."""
+        if len(values) == 0:
+            return
+        self._add(table, _update_fields_statement(table, tuple(values), _condition_shape(conditions)),
+                  tuple(values.values()) + _condition_values(conditions), _get_row_ids(table, conditions))
+
+    def upsert(self, table: str, key: str, values: dict) -> None:
+        """Inserts the row, or updates the other attributes if a row with the same key exists.
+        values has to contain the key."""
+        self._add(table, _upsert_statement(table, key, tuple(values)),
+                  tuple(values.values()), _get_row_ids(table, values))
+
+    def increase(self, table: str, attribute: str, amount: int, conditions: dict) -> None:
+        """Adds amount to the attribute of the rows matching the conditions."""
+        self._add(table, _increase_statement(table, attribute, _condition_shape(conditions)),
+                  (amount,) + _condition_values(conditions), _get_row_ids(table, conditions))
+
+    def increase_shop_count(self, user_id: int) -> None:
+        """Increases the shop count of the user, who's created if needed."""
+        self._add("users", _INCREASE_SHOP_COUNT, (int(user_id),))
+
+    def decrease_shop_count(self, user_id: int) -> None:
+        """Decreases the shop count of the user, but not below 0."""
+        self._add("users", _DECREASE_SHOP_COUNT, (int(user_id),))
+
+    def execute(self) -> None:
+        """Runs all collected writes in one transaction and clears them."""
+        con = get_connection()
+        with con:
+            for statement, parameters in self._operations:
+                con.executemany(statement, parameters)
+        _notify_write(self._changes)
+        self._operations = []
+        self._changes = {}
+
+    def _add(self, table: str, statement: str, parameters: tuple, ids: set[int] = None) -> None:
+        _add_change(self._changes, table, ids)
+        if len(self._operations) > 0 and self._operations[-1][0] == statement:
+            self._operations[-1][1].append(parameters)
+        else:
+            self._operations.append((statement, [parameters]))
+
+    def merge(self, other: "Transaction") -> None:
+        """Adds the writes collected by the other transaction, e.g. the ones of an item
+        whose Discord requests succeeded."""
+        for statement, parameters in other._operations:
+            if len(self._operations) > 0 and self._operations[-1][0] == statement:
+                self._operations[-1][1].extend(parameters)
+            else:
+                self._operations.append((statement, list(parameters)))
+        for table, ids in other._changes.items():
+            _add_change(self._changes, table, ids)
+
+    def __len__(self) -> int:
+        return sum(len(parameters) for _, parameters in self._operations)
+
+
+@contextlib.contextmanager
+def transaction():
+    """Yields a Transaction that is executed when the block is left without an error."""
+    batch = Transaction()
+    yield batch
+    batch.execute()
+
+
+def execute_transaction(batch: Transaction) -> None:
+    """Runs the collected writes of the transaction."""
+    batch.execute()
+
+
+# The tables allocate_id hands out ids for, with their id column
+_ID_COLUMNS = {"shops": "shop_id", "offers": "offer_id", "votings": "voting_id"}
+FIRST_ID = 1000
+
+
+def allocate_id(table: str) -> int:
+    """Returns an id for a new row in the table that isn't used and won't be handed out again.
+    Ids are counted up from FIRST_ID, so they stay short, and skip the ones that are taken
+    (e.g. the old random ones), which costs one index lookup each and only happens once."""
+    column = _ID_COLUMNS[table]
+    con = get_connection()
+    with con:
+        # Writing first takes the write lock, so nobody else can allocate until we commit
+        con.execute("INSERT INTO id_sequences (name, next_id) VALUES (?, ?)\
+                    ON CONFLICT(name) DO NOTHING", (table, FIRST_ID))
+        identifier = con.execute("SELECT next_id FROM id_sequences WHERE name = ?",
+                                 (table,)).fetchone()[0]
+        while con.execute(f"SELECT 1 FROM {table} WHERE {column} = ?", (identifier,)).fetchone():
+            identifier += 1
+        con.execute("UPDATE id_sequences SET next_id = ? WHERE name = ?",
+                    (identifier + 1, table))
+    return identifier
 
 
 def get_shop_data(id: int):
-    return get_data("shops", {"shop_id": id},
+    """Returns (name, offer, location, category, approved, message_id, owners, obligatory)
+    of the shop, where owners is a list of user ids, or None if it doesn't exist."""
+    shop = get_data("shops", {"shop_id": id},
                     attribute="name, offer, location, category,\
-                        approved, message_id, owners, obligatory")
+                        approved, message_id, obligatory")
+    if shop is None:
+        return None
+    return shop[:6] + (get_shop_owners(id), shop[6])
+
+
+def get_shops_data(ids: list[int]) -> dict[int, tuple]:
+    """Returns the data of get_shop_data of all existing shops with the given ids by their
+    id, loaded with two queries no matter how many shops there are."""
+    ids = [int(id) for id in ids]
+    if len(ids) == 0:
+        return {}
+    shops = get_data("shops", {"shop_id": ids},
+                     attribute="shop_id, name, offer, location, category,\
+                        approved, message_id, obligatory", fetch_all=True)
+    owners = defaultdict(list)
+    for shop_id, user_id in get_data("shop_owners", {"shop_id": ids},
+                                     attribute="shop_id, user_id", fetch_all=True):
+        owners[shop_id].append(int(user_id))
+    return {shop[0]: shop[1:7] + (owners[shop[0]], shop[7]) for shop in shops}
+
+
+def get_shop_owners(shop_id: int) -> list[int]:
+    """Returns the user ids of the owners of the shop."""
+    owners = get_data("shop_owners", {"shop_id": shop_id},
+                      attribute="user_id", fetch_all=True)
+    return [int(owner[0]) for owner in owners]
+
+
+def get_user_shops(user_id: int, attribute: str = "shop_id, name") -> list[tuple]:
+    """Returns the given attributes of all shops the user owns."""
+    attribute = attribute.replace(';', '')
+    return get_connection().execute(
+        f"SELECT {attribute} FROM shops WHERE shop_id IN\
+            (SELECT shop_id FROM shop_owners WHERE user_id = ?)", (int(user_id),)).fetchall()
 
 
 def increase_shop_count(user_id: int) -> None:
-    if get_data("users", {"user_id": user_id}) is None:
-        save_data("users", "user_id, offers_count, shop_count",
-                  (int(user_id), 0, 1))
-    else:
-        user_count = get_data(
-            "users", {"user_id": user_id}, attribute="shop_count")[0]
-        update_data("users", "shop_count", int(
-            user_count) + 1, {"user_id": user_id})
+    con = get_connection()
+    with con:
+        con.execute(_INCREASE_SHOP_COUNT, (int(user_id),))
 
 
 def decrease_shop_count(user_id: int) -> None:
-    try:
-        user_count = get_data(
-            "users", {"user_id": user_id}, attribute="shop_count")[0]
-    except TypeError:
-        raise ValueError(f"User with ID {user_id} does not exist.")
-    if user_count == 0:
+    con = get_connection()
+    with con:
+        changed = con.execute(_DECREASE_SHOP_COUNT, (int(user_id),)).rowcount
+    if changed == 0:
         raise ValueError(f"User with ID {user_id} has no shops.")
-    update_data("users", "shop_count", int(
-        user_count) - 1, {"user_id": user_id})
+
+
+def get_counts(user_id: int) -> tuple[int, int]:
+    """Returns (offers_count, shop_count) of the user, both 0 if the user isn't known."""
+    counts = get_data("users", {"user_id": int(user_id)},
+                      attribute="COALESCE(offers_count, 0), COALESCE(shop_count, 0)")
+    if counts is None:
+        return 0, 0
+    return counts
+
+
+def search_shops(text: str, limit: int = 25) -> list[int]:
+    """Returns the ids of the approved shops whose name, offer or location match all words
+    of the text (as prefixes), best matches first."""
+    # Every word is quoted, so the user can't use (or break) the fts5 query syntax
+    words = [word.replace('"', '""') for word in text.split()]
+    if len(words) == 0:
+        return []
+    query = " ".join(f'"{word}"*' for word in words)
+    shops = get_connection().execute(
+        "SELECT shops.shop_id FROM shops_fts JOIN shops ON shops.shop_id = shops_fts.rowid\
+            WHERE shops_fts MATCH ? AND shops.approved\
+            ORDER BY bm25(shops_fts, 10.0, 5.0, 2.0) LIMIT ?", (query, limit)).fetchall()
+    return [shop[0] for shop in shops]
+
+
+@functools.lru_cache(maxsize=8)
+def _adjacent_shop_statement(bounded: bool, previous: bool) -> str:
+    # One category at a time, so the rows come in shop_id order from the category index
+    # and sqlite stops at the first approved one (IN over several categories sorts them)
+    statement = "SELECT shop_id FROM shops WHERE approved AND category = ?"
+    if bounded:
+        statement += " AND shop_id < ?" if previous else " AND shop_id > ?"
+    return statement + (" ORDER BY shop_id DESC LIMIT 1" if previous else " ORDER BY shop_id LIMIT 1")
+
+
+def get_adjacent_shop_id(categories: list[str], shop_id: int = None, previous: bool = False) -> int | None:
+    """Returns the id of the approved shop in the categories after (or before, if previous)
+    the shop_id, or the first (last) one if shop_id is None. None if there is none.
+    This is keyset pagination: every page is one indexed lookup per category, no matter
+    how far in."""
+    statement = _adjacent_shop_statement(shop_id is not None, previous)
+    con = get_connection()
+    shop_ids = []
+    for category in set(categories):
+        parameters = (category,) if shop_id is None else (category, int(shop_id))
+        shop = con.execute(statement, parameters).fetchone()
+        if shop is not None:
+            shop_ids.append(shop[0])
+    if len(shop_ids) == 0:
+        return None
+    return max(shop_ids) if previous else min(shop_ids)
+
+
+def count_shops(categories: list[str]) -> int:
+    """Returns the number of approved shops in the categories."""
+    statement = f"SELECT COUNT(*) FROM shops WHERE approved AND category IN ({', '.join('?' * len(categories))})"
+    return get_connection().execute(statement, list(categories)).fetchone()[0]
+
+
+def get_due(table: str, id_column: str, deadline_column: str, before: float) -> list[tuple]:
+    """Returns (id, deadline) of the rows whose deadline is before (or at) the given time,
+    soonest first. The deadline column should be indexed."""
+    table, id_column, deadline_column = (name.replace(';', '') for name in (table, id_column, deadline_column))
+    return get_connection().execute(
+        f"SELECT {id_column}, {deadline_column} FROM {table} WHERE {deadline_column} <= ?\
+            ORDER BY {deadline_column}", (before,)).fetchall()
+
+
+def get_upcoming(table: str, id_column: str, deadline_column: str, after: float) -> list[tuple]:
+    """Returns (id, deadline) of the rows whose deadline is after the given time."""
+    table, id_column, deadline_column = (name.replace(';', '') for name in (table, id_column, deadline_column))
+    return get_connection().execute(
+        f"SELECT {id_column}, {deadline_column} FROM {table} WHERE {deadline_column} > ?",
+        (after,)).fetchall()
+
+
+def record_failed_expiry(kind: str, item_id: int, error: str, failed_at: float) -> int:
+    """Records that expiring the item failed. Returns how often it failed so far."""
+    con = get_connection()
+    with con:
+        con.execute(
+            "INSERT INTO failed_expiries (kind, item_id, attempts, last_error, failed_at)\
+                VALUES (?, ?, 1, ?, ?) ON CONFLICT(kind, item_id) DO UPDATE SET\
+                attempts = attempts + 1, last_error = excluded.last_error,\
+                failed_at = excluded.failed_at", (kind, int(item_id), error, failed_at))
+        attempts = con.execute("SELECT attempts FROM failed_expiries WHERE kind = ? AND item_id = ?",
+                               (kind, int(item_id))).fetchone()[0]
+    _notify_write({"failed_expiries": None})
+    return attempts
+
+
+def get_failed_expiries(kind: str, item_ids: list[int]) -> dict[int, tuple[int, float]]:
+    """Returns (attempts, failed_at) of the items whose expiry failed before, by their id."""
+    failures = get_data("failed_expiries", {"kind": kind, "item_id": [int(id) for id in item_ids]},
+                        attribute="item_id, attempts, failed_at", fetch_all=True)
+    return {item_id: (attempts, failed_at) for item_id, attempts, failed_at in failures}
+
+
+def clear_failed_expiries(kind: str, item_ids: list[int]) -> None:
+    """Forgets the failures of the items, because they were expired now."""
+    delete_data("failed_expiries", {"kind": kind, "item_id": [int(id) for id in item_ids]})
 
 
 def get_voting_data(id: int):
     return get_data("votings", {"voting_id": id},
                     attribute="user_id, message_id, deadline,\
                         description, wait_time, create_time, time_type")
+
+
+def get_votings_data(*conditions: dict) -> list[tuple]:
+    """Returns the voting id followed by the data of get_voting_data of all votings
+    matching the conditions, with one query."""
+    return get_data("votings", *conditions,
+                    attribute="voting_id, user_id, message_id, deadline,\
+                        description, wait_time, create_time, time_type", fetch_all=True)
@@ -0,0 +1,247 @@
+import asyncio
+import heapq
+import traceback
+from time import time
+
+import classes.async_database as db
+from classes import request_scheduler
+
+# Expires offers, votings and vacations at their deadline. All deadlines are kept in a
+# heap, the scheduler sleeps until the next one is due (or a new one comes first).
+# Changing or cancelling a deadline doesn't touch the heap, outdated entries are just
+# skipped when they come up. Due items are expired in their own tasks, so a slow expiry
+# doesn't hold up the deadlines after it.
+
+# The deadline column of each kind of item: (table, id column, deadline column)
+DEADLINE_COLUMNS = {
+    "offers": ("offers", "offer_id", "deadline"),
+    "votings": ("votings", "voting_id", "deadline"),
+    "vacations": ("vacations", "ID", "end_date"),
+}
+# Vacations end with the end of their last day, end_date is its start
+DEADLINE_OFFSETS = {"vacations": 86400}
+# How many overdue items of a kind are expired together when catching up. Offer and
+# vacation messages are bulk deleted, closing a voting takes several requests.
+CATCH_UP_BATCH_SIZES = {"offers": 100, "vacations": 100, "votings": 1}
+# When an item whose expiry failed is tried again, by the number of failures so far.
+# After that only the daily sweep tries again, until the item is given up after
+# MAX_ATTEMPTS failures. The failures are stored, so this holds across restarts.
+RETRY_DELAYS = [60, 300, 1800, 6 * 3600]
+MAX_ATTEMPTS = len(RETRY_DELAYS) + 3
+
+
+class DeadlineScheduler():
+    def __init__(self) -> None:
+        self._heap: list[tuple[float, str, int]] = []
+        # The current deadline of every scheduled item, entries in the heap that don't
+        # match it are outdated
+        self._deadlines: dict[tuple[str, int], float] = {}
+        self._handlers: dict[str, object] = {}
+        # The items being expired right now, so the scheduler, the daily sweep and the
+        # retries never expire the same item twice at once
+        self._in_flight: set[tuple[str, int]] = set()
+        # The running expiries, the loop only keeps a weak reference to them
+        self._expiries: set[asyncio.Task] = set()
+        self._wake: asyncio.Event = None
+        self._task: asyncio.Task = None
+
+    def register(self, kind: str, handler) -> None:
+        """Sets the handler of a kind of item. It's called as await handler(ids) with the
+        ids of all items of the kind that are due."""
+        self._handlers[kind] = handler
+
+    def schedule(self, kind: str, id: int, deadline: float) -> None:
+        """Schedules (or reschedules) the item to expire at the deadline (epoch seconds)."""
+        deadline = float(deadline)
+        self._deadlines[(kind, int(id))] = deadline
+        heapq.heappush(self._heap, (deadline, kind, int(id)))
+        self._compact()
+        if self._wake is not None and self._heap[0][0] == deadline:
+            # It's the next one, so the sleep has to be shortened
+            self._wake.set()
+
+    def cancel(self, kind: str, id: int) -> None:
+        """Unschedules the item, e.g. because it was deleted."""
+        self._deadlines.pop((kind, int(id)), None)
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    async def load(self, after: float = None) -> None:
+        """Schedules all items in the database that are due after the given time (default
+        now). Pass the time catch_up() used, so nothing falls between the two. Items that
+        are scheduled already (e.g. for a retry) are kept."""
+        now = time() if after is None else after
+        for kind, (table, id_column, deadline_column) in DEADLINE_COLUMNS.items():
+            offset = DEADLINE_OFFSETS.get(kind, 0)
+            for id, deadline in await db.get_upcoming(table, id_column, deadline_column, now - offset):
+                if (kind, int(id)) not in self._deadlines:
+                    self.schedule(kind, id, deadline + offset)
+
+    async def catch_up(self, now: float = None, concurrency: int = 4) -> None:
+        """Expires everything that got due while the bot was offline (up to now, default
+        the current time), soonest first and at most concurrency batches at a time."""
+        now = time() if now is None else now
+        batches = []
+        for kind, (table, id_column, deadline_column) in DEADLINE_COLUMNS.items():
+            rows = await db.get_due(table, id_column, deadline_column,
+                                    now - DEADLINE_OFFSETS.get(kind, 0))
+            size = CATCH_UP_BATCH_SIZES.get(kind, 1)
+            for start in range(0, len(rows), size):
+                batch = rows[start:start + size]
+                batches.append((batch[0][1] + DEADLINE_OFFSETS.get(kind, 0), kind,
+                                [id for id, _ in batch]))
+        if len(batches) == 0:
+            return
+        batches.sort(key=lambda batch: batch[0])
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def expire(kind: str, ids: list[int]) -> None:
+            async with semaphore:
+                for id in ids:
+                    self.cancel(kind, id)
+                await self.expire(kind, ids)
+
+        with request_scheduler.background():
+            # The semaphore lets the waiting batches in in order, so the soonest go first
+            await asyncio.gather(*(expire(kind, ids) for _, kind, ids in batches))
+        print(f"Caught up on {sum(len(ids) for _, _, ids in batches)} overdue items.")
+
+    def start(self) -> None:
+        """Starts waiting for the deadlines."""
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        """Stops waiting for the deadlines."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            self._drop_outdated()
+            if len(self._heap) == 0:
+                await self._wake.wait()
+                continue
+            delay = self._heap[0][0] - time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            with request_scheduler.background():
+                # The tasks run as background work, they take the context along
+                for kind, ids in self._pop_due().items():
+                    task = asyncio.get_running_loop().create_task(self.expire(kind, ids))
+                    self._expiries.add(task)
+                    task.add_done_callback(self._expiries.discard)
+
+    async def expire(self, kind: str, ids: list[int]) -> None:
+        """Expires the items with the handler of their kind. Items that are being expired
+        already (e.g. by the daily sweep) are skipped."""
+        ids = [int(id) for id in ids if (kind, int(id)) not in self._in_flight]
+        if kind in DEADLINE_COLUMNS and len(ids) > 0:
+            ids = await self._get_retryable(kind, ids)
+        if len(ids) == 0:
+            return
+        self._in_flight.update((kind, id) for id in ids)
+        try:
+            await self._expire(kind, ids)
+        finally:
+            self._in_flight.difference_update((kind, id) for id in ids)
+
+    async def _get_retryable(self, kind: str, ids: list[int]) -> list[int]:
+        """Returns the items that may be expired now. Items whose expiry failed before are
+        left out while their retry isn't due (it's scheduled instead) and once they're
+        given up."""
+        failures = await db.get_failed_expiries(kind, ids)
+        retryable = []
+        for id in ids:
+            if id not in failures:
+                retryable.append(id)
+                continue
+            attempts, failed_at = failures[id]
+            if attempts >= MAX_ATTEMPTS:
+                continue
+            retry_at = failed_at + RETRY_DELAYS[min(attempts, len(RETRY_DELAYS)) - 1]
+            if retry_at <= time():
+                retryable.append(id)
+            elif attempts <= len(RETRY_DELAYS):
+                self.schedule(kind, id, retry_at)
+        return retryable
+
+    async def _expire(self, kind: str, ids: list[int]) -> None:
+        handler = self._handlers.get(kind)
+        if handler is None:
+            print(f"No handler for expired {kind}: {ids}")
+            return
+        try:
+            await handler(ids)
+        except Exception:
+            print(f"Expiring {kind} {ids} failed:")
+            traceback.print_exc()
+
+    async def record_failure(self, kind: str, id: int, error: BaseException) -> None:
+        """Records that expiring the item failed and schedules a retry."""
+        attempts = await db.record_failed_expiry(kind, id, repr(error), time())
+        print(f"Expiring {kind} {id} failed ({attempts}. time): {error!r}")
+        if attempts >= MAX_ATTEMPTS:
+            print(f"Giving up on expiring {kind} {id}.")
+        elif attempts <= len(RETRY_DELAYS):
+            self.schedule(kind, id, time() + RETRY_DELAYS[attempts - 1])
+
+    async def record_success(self, kind: str, ids: list[int]) -> None:
+        """Forgets earlier failures of the items, they are expired now."""
+        if len(ids) > 0:
+            await db.clear_failed_expiries(kind, ids)
+
+    async def expire_each(self, kind: str, ids: list[int], expire, concurrency: int = 4) -> None:
+        """Runs await expire(id) for every item, at most concurrency at a time. A failing
+        item is recorded and retried later, so it can't stop the others.
+        expire isn't cancelled halfway (e.g. closing a voting after its tie-break was
+        posted), a hanging request fails by itself through the request scheduler's timeout."""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(id: int) -> bool:
+            async with semaphore:
+                try:
+                    await expire(id)
+                except Exception as e:
+                    await self.record_failure(kind, id, e)
+                    return False
+                return True
+
+        done = await asyncio.gather(*(run(id) for id in ids))
+        await self.record_success(kind, [id for id, success in zip(ids, done) if success])
+
+    def _pop_due(self) -> dict[str, list[int]]:
+        """Removes the items that are due and returns their ids by kind, soonest first."""
+        due = {}
+        now = time()
+        while len(self._heap) > 0 and self._heap[0][0] <= now:
+            deadline, kind, id = heapq.heappop(self._heap)
+            if self._deadlines.get((kind, id)) != deadline:
+                continue
+            del self._deadlines[(kind, id)]
+            due.setdefault(kind, []).append(id)
+        return due
+
+    def _drop_outdated(self) -> None:
+        while len(self._heap) > 0:
+            deadline, kind, id = self._heap[0]
+            if self._deadlines.get((kind, id)) == deadline:
+                return
+            heapq.heappop(self._heap)
+
+    def _compact(self) -> None:
+        # Rebuild the heap if it's mostly outdated entries, so it doesn't grow forever
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._deadlines):
+            self._heap = [(deadline, kind, id) for (kind, id), deadline in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+
+deadlines = DeadlineScheduler()
@@ -0,0 +1,59 @@
+import asyncio
+import traceback
+
+import interactions as i
+
+from classes import message_ops
+
+# Shop and voting messages are re-rendered a moment after an update instead of right
+# away, so several updates of the same message in a row (e.g. an admin going through
+# shops) only cost one edit: the last state within the window wins.
+
+
+class EmbedRenderer():
+    def __init__(self, delay: float = 2) -> None:
+        """Edits a message at most once per delay seconds, with the latest embed."""
+        self.delay = delay
+        # The latest pending render of each message: (client, channel id, render, on_missing)
+        self._pending: dict[int, tuple] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    def schedule(self, client: i.Client, channel_id: int, message_id: int, render,
+                 on_missing=None) -> None:
+        """Edits the message to the embed returned by await render() after the delay,
+        unless another render of it is scheduled before. If the message doesn't exist
+        anymore, await on_missing() is called (if given)."""
+        message_id = int(message_id)
+        self._pending[message_id] = (client, int(channel_id), render, on_missing)
+        if message_id not in self._tasks:
+            self._tasks[message_id] = asyncio.get_running_loop().create_task(
+                self._run(message_id))
+
+    def cancel(self, message_id: int) -> None:
+        """Drops the pending render of the message, e.g. because it's deleted."""
+        self._pending.pop(int(message_id), None)
+        task = self._tasks.pop(int(message_id), None)
+        if task is not None:
+            task.cancel()
+
+    async def _run(self, message_id: int) -> None:
+        try:
+            # Renders scheduled during an edit are done in the next round
+            while message_id in self._pending:
+                await asyncio.sleep(self.delay)
+                client, channel_id, render, on_missing = self._pending.pop(message_id)
+                try:
+                    embed = await render()
+                    if not await message_ops.edit_message(client, channel_id, message_id, embeds=embed) \
+                            and on_missing is not None:
+                        await on_missing()
+                except Exception:
+                    # A failed render is dropped, the next update of the message renders again
+                    print(f"Rendering message {message_id} failed:")
+                    traceback.print_exc()
+        finally:
+            if self._tasks.get(message_id) is asyncio.current_task():
+                del self._tasks[message_id]
+
+
+renderer = EmbedRenderer()
@@ -0,0 +1,125 @@
+import asyncio
+from time import time
+
+import interactions as i
+from interactions.client.errors import HTTPException, NotFound
+
+from classes import request_scheduler
+
+# Edits and deletes messages by channel and message id. Fetching a message first costs
+# a request (on the same rate limit) and is only needed if its content is used.
+# The requests go through the request scheduler with the channel id as route.
+
+# Discord only bulk deletes messages younger than 14 days, up to 100 at once
+BULK_DELETE_MAX_AGE = 14 * 86400
+BULK_DELETE_LIMIT = 100
+DISCORD_EPOCH = 1420070400
+# The DM channels by user id, they never change
+_dm_channels: dict[int, i.DM] = {}
+
+
+async def edit_message(client: i.Client, channel_id: int, message_id: int, content: str = None,
+                       embeds: list[i.Embed] | i.Embed = None) -> bool:
+    """Edits the content and/or embeds of the message.
+    Returns False if the message doesn't exist (anymore)."""
+    payload = {}
+    if content is not None:
+        payload["content"] = content
+    if embeds is not None:
+        if isinstance(embeds, i.Embed):
+            embeds = [embeds]
+        payload["embeds"] = [embed.to_dict() for embed in embeds]
+    try:
+        await request_scheduler.run(int(channel_id), client.http.edit_message,
+                                    payload, int(channel_id), int(message_id))
+    except NotFound:
+        return False
+    return True
+
+
+async def send_message(channel: i.GuildText | i.DM, **kwargs) -> i.Message:
+    """Sends a message to the channel, see channel.send for the arguments."""
+    return await request_scheduler.run(int(channel.id), channel.send, **kwargs)
+
+
+async def send_dms(users: list[i.BaseUser], concurrency: int = 5, **kwargs) -> list[i.BaseUser]:
+    """Sends the message (see channel.send for the arguments) to every user by DM, to at
+    most concurrency users at a time. Returns the users it couldn't be sent to, e.g.
+    because they don't accept DMs or the request timed out."""
+    users = list(users)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(user: i.BaseUser) -> bool:
+        async with semaphore:
+            try:
+                channel = _dm_channels.get(int(user.id))
+                if channel is None:
+                    channel = await request_scheduler.run(("dm", int(user.id)), user.fetch_dm)
+                    _dm_channels[int(user.id)] = channel
+                await send_message(channel, **kwargs)
+            except (HTTPException, asyncio.TimeoutError):
+                # A hanging request fails by the request scheduler's timeout
+                return False
+            return True
+
+    sent = await asyncio.gather(*(send(user) for user in users))
+    return [user for user, success in zip(users, sent) if not success]
+
+
+async def fetch_message(channel: i.GuildText, message_id: int) -> i.Message | None:
+    """Fetches the message, for when its content is needed. None if it doesn't exist."""
+    return await request_scheduler.run(int(channel.id), channel.fetch_message, message_id)
+
+
+async def add_reaction(message: i.Message, emoji: str) -> None:
+    """Adds the reaction to the message."""
+    await request_scheduler.run(("reactions", int(message.channel.id)), message.add_reaction, emoji)
+
+
+async def delete_message(client: i.Client, channel_id: int, message_id: int) -> bool:
+    """Deletes the message. Returns False if it didn't exist (anymore)."""
+    try:
+        await request_scheduler.run(int(channel_id), client.http.delete_message,
+                                    int(channel_id), int(message_id))
+    except NotFound:
+        return False
+    return True
+
+
+def get_message_age(message_id: int) -> float:
+    """Returns the age of the message in seconds, taken from its snowflake id."""
+    return time() - ((int(message_id) >> 22) / 1000 + DISCORD_EPOCH)
+
+
+async def delete_messages(client: i.Client, channel_id: int, message_ids: list[int]) -> dict[int, Exception]:
+    """Deletes the messages of the channel, as many as possible with bulk deletes.
+    Messages that are too old for a bulk delete (or don't exist anymore) are deleted
+    one by one. Returns the errors of the messages that couldn't be deleted by their id,
+    messages that don't exist (anymore) count as deleted."""
+    bulk_ids, single_ids = [], []
+    for message_id in {int(message_id) for message_id in message_ids}:
+        # A bit of leeway, the age is checked by Discord when the request arrives
+        if get_message_age(message_id) < BULK_DELETE_MAX_AGE - 3600:
+            bulk_ids.append(message_id)
+        else:
+            single_ids.append(message_id)
+    for start in range(0, len(bulk_ids), BULK_DELETE_LIMIT):
+        chunk = bulk_ids[start:start + BULK_DELETE_LIMIT]
+        if len(chunk) < 2:
+            single_ids.extend(chunk)
+            continue
+        try:
+            await request_scheduler.run(int(channel_id), client.http.bulk_delete_messages,
+                                        int(channel_id), chunk)
+        except (HTTPException, asyncio.TimeoutError):
+            single_ids.extend(chunk)
+
+    # They share the channel's route (and rate limit), so the scheduler runs them one
+    # after another anyway. A hanging delete fails by the scheduler's timeout.
+    failed = {}
+    for message_id in single_ids:
+        try:
+            await delete_message(client, channel_id, message_id)
+        except Exception as e:
+            failed[message_id] = e
+    return failed
@@ -0,0 +1,129 @@
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+from time import monotonic
+
+# All requests to Discord that the bot makes on its own go through here, so background
+# work (cleanups, closing votings, DMs) can't slow down the answers to commands: queued
+# interactive requests always go first. Requests on the same route (usually a channel)
+# run one after another, since they share Discord's rate limit bucket anyway, while
+# requests on different routes run side by side. A request that hangs is cancelled after
+# the timeout, so it can't block its route forever.
+
+INTERACTIVE = 0
+BACKGROUND = 1
+_PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "request_priority", default=INTERACTIVE)
+
+
+@contextlib.contextmanager
+def background():
+    """Runs the requests made in the block (and in tasks started from it) as background work."""
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class _Stats():
+    def __init__(self) -> None:
+        self.queued = 0
+        self.done = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def add_wait(self, wait: float) -> None:
+        self.done += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+
+class RequestScheduler():
+    def __init__(self, concurrency: int = 4, timeout: float = 30) -> None:
+        """Runs up to concurrency requests at a time, interactive ones first.
+        A request that takes longer than timeout seconds fails with asyncio.TimeoutError."""
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._queue: list[tuple] = []
+        self._counter = itertools.count()
+        self._busy_routes: set = set()
+        self._running = 0
+        self._stats = {priority: _Stats() for priority in _PRIORITY_NAMES}
+
+    async def run(self, route, func, *args, priority: int = None, **kwargs):
+        """Queues await func(*args, **kwargs) on the route and returns its result.
+        The priority defaults to the one of the current context, see background()."""
+        if priority is None:
+            priority = _priority.get()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._counter), route, monotonic(),
+                                     future, func, args, kwargs))
+        self._stats[priority].queued += 1
+        self._dispatch()
+        return await future
+
+    def stats(self) -> dict[str, dict]:
+        """Returns the queue depth and wait times (in seconds) by priority."""
+        stats = {}
+        for priority, name in _PRIORITY_NAMES.items():
+            priority_stats = self._stats[priority]
+            stats[name] = {
+                "queued": priority_stats.queued,
+                "done": priority_stats.done,
+                "average_wait": priority_stats.total_wait / priority_stats.done if priority_stats.done else 0.0,
+                "max_wait": priority_stats.max_wait
+            }
+        stats["running"] = self._running
+        return stats
+
+    def _dispatch(self) -> None:
+        skipped = []
+        while self._running < self.concurrency and len(self._queue) > 0:
+            request = heapq.heappop(self._queue)
+            if request[2] in self._busy_routes:
+                skipped.append(request)
+                continue
+            self._start(*request)
+        for request in skipped:
+            heapq.heappush(self._queue, request)
+
+    def _start(self, priority: int, _, route, queued_at: float, future: asyncio.Future,
+               func, args, kwargs) -> None:
+        self._stats[priority].queued -= 1
+        if future.cancelled():
+            return
+        self._stats[priority].add_wait(monotonic() - queued_at)
+        self._busy_routes.add(route)
+        self._running += 1
+        task = asyncio.ensure_future(asyncio.wait_for(func(*args, **kwargs), self.timeout))
+        task.add_done_callback(lambda task: self._finish(route, future, task))
+        # If the caller stops waiting (e.g. cancelled), the route is freed right away
+        future.add_done_callback(lambda future: task.cancel() if future.cancelled() else None)
+
+    def _finish(self, route, future: asyncio.Future, task: asyncio.Task) -> None:
+        self._busy_routes.discard(route)
+        self._running -= 1
+        if not future.done():
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+        elif not task.cancelled():
+            # Nobody waits for it anymore, but the exception shouldn't be reported as unretrieved
+            task.exception()
+        self._dispatch()
+
+
+scheduler = RequestScheduler()
+
+
+async def run(route, func, *args, priority: int = None, **kwargs):
+    """Runs the request through the shared scheduler, see RequestScheduler.run."""
+    return await scheduler.run(route, func, *args, priority=priority, **kwargs)
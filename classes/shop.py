@@ -1,6 +1,10 @@
 import interactions as i
-import classes.database as db
-import configparser as cp
+import classes.async_database as db
+from classes import message_ops
+from classes.config import get_config
+from classes.database import Transaction
+from classes.embed_renderer import renderer
+from classes.user_directory import directory
 from sqlite3 import IntegrityError
 
 
@@ -17,12 +21,11 @@ class Shop():
         approved: bool = False,
         message_id: int = None,
         owners: list[str | int] | str | int = None,
-        obligatory: bool = False,
-        skip_setup: bool = False
+        obligatory: bool = False
     ) -> None:
         """
         Representation of a shop.
-        If skip_setup is True, the shop won't be set up from the database.
+        Use Shop.load to set it up from the database.
         """
         self.id = int(id)
         self.client = dc_client
@@ -38,69 +41,104 @@ class Shop():
         elif type(owners) is list:
             self.owners = [int(owner) for owner in owners]
         self.obligatory = bool(obligatory)
+        # The values as they are in the database, so updates only write what changed
+        self._stored: dict = None
+        self._stored_owners: set[int] = None
 
         self._refresh_config()
-        if not skip_setup:
-            sucess = self._setup(self.id)
-            if not sucess:
-                raise ValueError("Shop not found.")
+
+    @classmethod
+    async def load(cls, id: int, dc_client: i.Client, channel: i.GuildText) -> "Shop":
+        """Returns the shop with the given id from the database.
+        Raises ValueError if it doesn't exist."""
+        shop = cls(id, dc_client, channel)
+        sucess = await shop._setup(shop.id)
+        if not sucess:
+            raise ValueError("Shop not found.")
+        return shop
+
+    @classmethod
+    async def load_many(cls, ids: list[int], dc_client: i.Client, channel: i.GuildText) -> list["Shop"]:
+        """Returns the shops with the given ids from the database, in the order of the ids.
+        All shops are loaded at once, ids that don't exist are left out."""
+        data = await db.get_shops_data(ids)
+        shops = []
+        for id in ids:
+            if int(id) not in data:
+                continue
+            shop = cls(id, dc_client, channel)
+            shop._apply(data[int(id)])
+            shops.append(shop)
+        return shops
 
     def _refresh_config(self):
-        with open('config.ini', 'r') as config_file:
-            config = cp.ConfigParser()
-            config.read_file(config_file)
-            self.categories_excluded_from_limit = config.get(
-                'Shops', 'categories_excluded_from_limit').split(",")
-            self.categories_excluded_from_limit = [
-                category.strip() for category in self.categories_excluded_from_limit]
-
-    async def update(self) -> None:
-        """Updates the shop in the database and the embed."""
-        # I know recreating is not the best option, but sufficient for this case.
-        db.delete_data("shops", {"shop_id": self.id})
-        db.save_data("shops", "name, offer, location, category, approved,\
-                     message_id, owners, shop_id, obligatory",
-                     (self.name, self.offer, self.location, self.category,
-                      self.approved, self.message_id,
-                      ",".join([str(owner) for owner in self.owners]), self.id, self.obligatory))
-        message = await self.channel.fetch_message(self.message_id)
-        embed = await self._get_embed()
-        await message.edit(embed=embed)
+        config = get_config()
+        self.categories_excluded_from_limit = config.get(
+            'Shops', 'categories_excluded_from_limit').split(",")
+        self.categories_excluded_from_limit = [
+            category.strip() for category in self.categories_excluded_from_limit]
 
-    async def delete(self) -> None:
-        """Deletes the shop from the database, the embed and set the owner counts."""
-        db.delete_data("shops", {"shop_id": self.id})
-        message = await self.channel.fetch_message(self.message_id)
-        await message.delete()
-        if self.category not in self.categories_excluded_from_limit:
-            for owner in self.owners:
-                db.decrease_shop_count(owner)
+    async def update(self, transaction: Transaction = None) -> None:
+        """Updates the shop in the database and (shortly after) the embed.
+        If a transaction is given, the database writes are added to it instead."""
+        async with db.transaction(transaction) as batch:
+            if self._stored is None:
+                batch.upsert("shops", "shop_id",
+                             {"shop_id": self.id, **self._columns()})
+            else:
+                changes = {column: value for column, value in self._columns().items()
+                           if self._stored[column] != value}
+                batch.update_fields("shops", changes, {"shop_id": self.id})
+            removed, added = self._save_owners(batch)
+            if self._stored_owners is not None \
+                    and self.category not in self.categories_excluded_from_limit:
+                for owner in removed:
+                    batch.decrease_shop_count(owner)
+                for owner in added:
+                    batch.increase_shop_count(owner)
+        self._remember()
+        renderer.schedule(self.client, self.channel.id, self.message_id, self._get_embed)
+
+    async def delete(self, transaction: Transaction = None) -> None:
+        """Deletes the shop from the database, the embed and set the owner counts.
+        If a transaction is given, the database writes are added to it instead."""
+        async with db.transaction(transaction) as batch:
+            batch.delete("shops", {"shop_id": self.id})
+            batch.delete("shop_owners", {"shop_id": self.id})
+            if self.category not in self.categories_excluded_from_limit:
+                for owner in self.owners:
+                    batch.decrease_shop_count(owner)
+        renderer.cancel(self.message_id)
+        await message_ops.delete_message(self.client, self.channel.id, self.message_id)
 
     async def create(self) -> None:
         """Creates the shop in the database, the embed and sets the owner counts."""
         embed = await self._get_embed()
-        message = await self.channel.send(embed=embed)
+        message = await message_ops.send_message(self.channel, embed=embed)
         self.message_id = int(message.id)
         try:
-            db.save_data("shops", "shop_id, name, offer, location, category, approved, message_id, owners, obligatory",
-                         (self.id, self.name, self.offer, self.location, self.category, self.approved,
-                          self.message_id, ",".join([str(owner) for owner in self.owners]), self.obligatory))
+            async with db.transaction() as batch:
+                batch.save("shops", "shop_id, name, offer, location, category, approved, message_id, obligatory",
+                           (self.id, self.name, self.offer, self.location, self.category, self.approved,
+                            self.message_id, self.obligatory))
+                self._save_owners(batch)
+                if self.category not in self.categories_excluded_from_limit:
+                    for owner in set(self.owners):
+                        batch.increase_shop_count(owner)
         except IntegrityError:
-            await message.delete()
+            await message_ops.delete_message(self.client, self.channel.id, message.id)
             raise ValueError("Shop already exists.")
-        if self.category not in self.categories_excluded_from_limit:
-            for owner in self.owners:
-                db.increase_shop_count(int(owner))
+        self._remember()
 
-    async def approve(self) -> None:
+    async def approve(self, transaction: Transaction = None) -> None:
         """Approves the shop."""
         self.approved = True
-        await self.update()
+        await self.update(transaction)
 
-    async def deny(self) -> None:
+    async def deny(self, transaction: Transaction = None) -> None:
         """Denies the shop."""
         self.approved = False
-        await self.update()
+        await self.update(transaction)
 
     def set_id(self, id: int) -> None:
         """Sets the id of the shop."""
@@ -135,21 +173,53 @@ class Shop():
         """Returns the embed of the shop."""
         return self._get_embed()
 
-    def _setup(self, id: int) -> bool:
+    async def _setup(self, id: int) -> bool:
         """Sets up the shop if it's found in the database.
         Returns True if the shop was found, False otherwise."""
-        shop = db.get_shop_data(id)
+        shop = await db.get_shop_data(id)
         if shop is None:
             return False
+        self._apply(shop)
+        return True
+
+    def _apply(self, shop: tuple) -> None:
+        """Sets the shop up from its data as returned by get_shop_data."""
         self.name = shop[0]
         self.offer = shop[1].replace("\\n", "\n")
         self.location = shop[2]
         self.category = shop[3]
         self.approved = bool(shop[4])
         self.message_id = int(shop[5])
-        self.owners = [int(owner) for owner in shop[6].split(",")]
+        self.owners = shop[6]
         self.obligatory = bool(shop[7])
-        return True
+        self._remember()
+
+    def _columns(self) -> dict:
+        """Returns the values of the shop by their column in the shops table."""
+        return {"name": self.name, "offer": self.offer, "location": self.location,
+                "category": self.category, "approved": self.approved,
+                "message_id": self.message_id, "obligatory": self.obligatory}
+
+    def _remember(self) -> None:
+        """Remembers the current values as the ones stored in the database."""
+        self._stored = self._columns()
+        self._stored_owners = {int(owner) for owner in self.owners}
+
+    def _save_owners(self, transaction: Transaction) -> tuple[set[int], set[int]]:
+        """Adds the changes of the owners since they were stored to the transaction.
+        Returns the removed and the added owners."""
+        owners = {int(owner) for owner in self.owners}
+        if self._stored_owners is None:
+            transaction.delete("shop_owners", {"shop_id": self.id})
+            removed, added = set(), owners
+        else:
+            removed, added = self._stored_owners - owners, owners - self._stored_owners
+        if len(removed) > 0:
+            transaction.delete(
+                "shop_owners", {"shop_id": self.id, "user_id": sorted(removed)})
+        transaction.save_many("shop_owners", "shop_id, user_id",
+                              [(self.id, owner) for owner in sorted(added)])
+        return removed, added
 
     async def _get_embed(self) -> i.Embed:
         """Return the embed of the shop."""
@@ -189,8 +259,5 @@ class Shop():
 
     async def _get_owner_names(self) -> str:
         """Returns a string of the names of the owners of the shop."""
-        name_str = ""
-        for owner in self.owners:
-            user: i.User = await self.client.fetch_user(owner)
-            name_str += user.display_name + ", "
-        return name_str[:-2]
+        names = await directory.get_names(self.client, self.owners)
+        return ", ".join(names)
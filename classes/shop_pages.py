@@ -0,0 +1,77 @@
+import re
+
+import interactions as i
+
+import classes.async_database as db
+from classes.shop import Shop
+
+# Custom ids of the page buttons: shop_page_<step>_<shop id of the shown page>_<page number>.
+# The shown shop and its page number are part of the custom id, so a page only needs
+# the id to go on from and nothing has to be counted.
+page_button_callback_id = re.compile(r"shop_page_(first|previous|next|last)_(\d+)_(\d+)")
+
+
+class ShopPages():
+    def __init__(self, client: i.Client, channel: i.GuildText, categories: list[str] = None,
+                 shop_ids: list[int] = None) -> None:
+        """Pages through shops, one shop per page. The pages are either the approved shops in
+        the categories (fetched page by page from the database) or the given shop ids.
+        A shop is only loaded and rendered when its page is shown."""
+        self.client = client
+        self.channel = channel
+        self.categories = categories
+        self.shop_ids = shop_ids
+        self._total: int = None
+
+    async def get_shop_id(self, step: str, shop_id: int = None) -> int | None:
+        """Returns the id of the shop step ("first", "previous", "next" or "last") away from
+        the shop_id. None if there is no such shop."""
+        if self.shop_ids is not None:
+            if len(self.shop_ids) == 0:
+                return None
+            if step == "first":
+                return self.shop_ids[0]
+            if step == "last":
+                return self.shop_ids[-1]
+            index = self.shop_ids.index(shop_id) + (1 if step == "next" else -1)
+            return self.shop_ids[index] if 0 <= index < len(self.shop_ids) else None
+        if step in ("first", "last"):
+            shop_id = None
+        return await db.get_adjacent_shop_id(self.categories, shop_id,
+                                             previous=step in ("previous", "last"))
+
+    async def get_total(self) -> int:
+        """Returns the number of pages, counted once on first use."""
+        if self.shop_ids is not None:
+            return len(self.shop_ids)
+        if self._total is None:
+            self._total = await db.count_shops(self.categories)
+        return self._total
+
+    async def get_page(self, step: str, page: int = 1) -> int:
+        """Returns the page number step away from the page."""
+        if step == "first":
+            return 1
+        if step == "last":
+            return await self.get_total()
+        return max(1, page + (1 if step == "next" else -1))
+
+    async def render(self, shop_id: int, page: int = 1) -> dict:
+        """Returns the message (as keyword arguments for send/edit) showing the shop
+        on the given page."""
+        shop = await Shop.load(shop_id, self.client, self.channel)
+        embed = await shop.get_embed()
+        total = await self.get_total()
+        buttons = [
+            i.Button(style=i.ButtonStyle.BLURPLE, emoji="⏮️",
+                     custom_id=f"shop_page_first_{shop_id}_{page}", disabled=page <= 1),
+            i.Button(style=i.ButtonStyle.BLURPLE, emoji="⬅️",
+                     custom_id=f"shop_page_previous_{shop_id}_{page}", disabled=page <= 1),
+            i.Button(style=i.ButtonStyle.GREY, label=f"{page}/{total}",
+                     custom_id=f"shop_page_position_{shop_id}_{page}", disabled=True),
+            i.Button(style=i.ButtonStyle.BLURPLE, emoji="➡️",
+                     custom_id=f"shop_page_next_{shop_id}_{page}", disabled=page >= total),
+            i.Button(style=i.ButtonStyle.BLURPLE, emoji="⏭️",
+                     custom_id=f"shop_page_last_{shop_id}_{page}", disabled=page >= total)
+        ]
+        return {"embeds": [embed], "components": [i.ActionRow(*buttons)]}
@@ -0,0 +1,89 @@
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+
+import interactions as i
+
+from classes import request_scheduler
+
+# Display names of users for the embeds, so building an embed doesn't fetch every
+# owner from Discord. Names are filled from the member events (GUILD_MEMBERS intent)
+# and the client cache, and only fetched if neither has them.
+
+
+class UserDirectory():
+    def __init__(self, max_size: int = 2048, ttl: float = 3600) -> None:
+        """Remembers up to max_size display names for ttl seconds each.
+        The least recently used name is dropped first when it's full."""
+        self.max_size = max_size
+        self.ttl = ttl
+        self._names: OrderedDict[int, tuple[str, float]] = OrderedDict()
+
+    def get(self, user_id: int) -> str | None:
+        """Returns the remembered display name of the user, None if unknown or expired."""
+        entry = self._names.get(int(user_id))
+        if entry is None:
+            return None
+        name, expires = entry
+        if expires <= monotonic():
+            del self._names[int(user_id)]
+            return None
+        self._names.move_to_end(int(user_id))
+        return name
+
+    def put(self, user_id: int, name: str) -> None:
+        """Remembers the display name of the user."""
+        self._names[int(user_id)] = (str(name), monotonic() + self.ttl)
+        self._names.move_to_end(int(user_id))
+        while len(self._names) > self.max_size:
+            self._names.popitem(last=False)
+
+    def remember(self, user: i.BaseUser | i.Member) -> None:
+        """Remembers the display name of the user (or member)."""
+        if isinstance(user, i.Member):
+            user = user.user
+        if user is not None:
+            self.put(user.id, user.display_name)
+
+    def forget(self, user_id: int) -> None:
+        """Forgets the user, e.g. because they left."""
+        self._names.pop(int(user_id), None)
+
+    def warm(self, client: i.Client) -> None:
+        """Remembers the names of all users the client has cached (e.g. on startup)."""
+        for user in list(client.cache.user_cache.values()):
+            self.remember(user)
+
+    async def get_names(self, client: i.Client, user_ids: list[int]) -> list[str]:
+        """Returns the display names of the users. Unknown users are looked up in the
+        client cache first and the rest are fetched concurrently."""
+        names = {}
+        missing = set()
+        for user_id in user_ids:
+            name = self.get(user_id)
+            if name is None:
+                user = client.get_user(user_id)
+                if user is not None:
+                    self.remember(user)
+                    name = user.display_name
+            if name is None:
+                missing.add(int(user_id))
+            else:
+                names[int(user_id)] = name
+        if len(missing) > 0:
+            users = await asyncio.gather(*(request_scheduler.run(("user", user_id), client.fetch_user, user_id)
+                                           for user_id in missing))
+            for user_id, user in zip(missing, users):
+                if user is not None:
+                    self.remember(user)
+                    names[user_id] = user.display_name
+                else:
+                    names[user_id] = str(user_id)
+        return [names[int(user_id)] for user_id in user_ids]
+
+    async def get_name(self, client: i.Client, user_id: int) -> str:
+        """Returns the display name of the user."""
+        return (await self.get_names(client, [user_id]))[0]
+
+
+directory = UserDirectory()
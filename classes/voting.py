@@ -1,12 +1,21 @@
-import configparser as cp
+import asyncio
 import re
-from random import randint
 from sqlite3 import IntegrityError
-from time import localtime, sleep, strftime, time
+from time import localtime, strftime, time
 
 import interactions as i
 
-import classes.database as db
+import classes.async_database as db
+from classes import message_ops, request_scheduler
+from classes.config import get_config
+from classes.database import Transaction
+from classes.deadline_scheduler import deadlines
+from classes.embed_renderer import renderer
+from classes.user_directory import directory
+
+
+# Votings whose reactions are still being added
+_reaction_tasks: set[asyncio.Task] = set()
 
 
 class Voting():
@@ -21,12 +30,11 @@ class Voting():
             wait_time: float = 0,
             create_time: float = 0,
             time_type: str = "Tag(e)",
-            count: int = 2,
-            skip_setup: bool = False
+            count: int = 2
     ) -> None:
         """
         Representation of a voting.
-        If skip_setup is True, the voting won't be set up from the database.
+        Use Voting.load to set it up from the database.
         """
         self.id = id
         self.client = dc_client
@@ -38,40 +46,69 @@ class Voting():
         self.create_time = create_time
         self.time_type = time_type
         self.count = count
+        # The values as they are in the database, so updates only write what changed
+        self._stored: dict = None
         self._emote_chars = ["\U0001F1E6", "\U0001F1E7", "\U0001F1E8", "\U0001F1E9", "\U0001F1EA",
                              "\U0001F1EB", "\U0001F1EC", "\U0001F1ED", "\U0001F1EE", "\U0001F1EF"]
 
         self._refresh_config()
-        if not skip_setup and not self._setup(self.id):
+
+    @classmethod
+    async def load(cls, id: int, dc_client: i.Client) -> "Voting":
+        """Returns the voting with the given id from the database.
+        Raises ValueError if it doesn't exist."""
+        voting = cls(id, dc_client)
+        if not await voting._setup(voting.id):
             raise ValueError("Voting not found.")
+        return voting
+
+    @classmethod
+    async def load_all(cls, dc_client: i.Client, where: dict = None) -> list["Voting"]:
+        """Returns all votings matching the conditions in where (e.g. {"voting_id": [...]})
+        from the database, loaded with one query."""
+        votings = []
+        for data in await db.get_votings_data(*([where] if where else [])):
+            voting = cls(data[0], dc_client)
+            voting._apply(data[1:])
+            votings.append(voting)
+        return votings
 
     async def create(self, emotes: list[str] = None) -> None:
         """Creates the voting in the database and the embed.
+        The reactions are added in the background.
         If emotes is given it will use the given ones instead."""
         if emotes is None:
             emotes = []
         embed = await self._get_embed()
         voting_role = await self._get_voting_role_to_ping()
-        message = await self.channel.send(content=voting_role.mention, embed=embed)
+        message = await message_ops.send_message(self.channel, content=voting_role.mention, embed=embed)
         self.message_id = message.id
         try:
-            self._save()
+            async with db.transaction() as batch:
+                self._save(batch)
         except IntegrityError:
-            await message.delete()
+            await message_ops.delete_message(self.client, self.channel.id, message.id)
             raise ValueError("Voting already exists.")
+        self._remember()
+        deadlines.schedule("votings", self.id, self.deadline)
 
-        if len(emotes) > 0:
-            for emote in emotes:
-                await message.add_reaction(emote)
-        else:
-            emote_index = 0
-            while self.count > emote_index:
-                await message.add_reaction(self._emote_chars[emote_index])
-                emote_index += 1
-                sleep(0.5)
-
-    async def update(self, notice: bool = True) -> None:
-        """Updates the voting in the database and the embed."""
+        if len(emotes) == 0:
+            emotes = self._emote_chars[:self.count]
+        with request_scheduler.background():
+            task = asyncio.get_running_loop().create_task(self._add_reactions(message, emotes))
+        # The loop only keeps a weak reference to the task
+        _reaction_tasks.add(task)
+        task.add_done_callback(_reaction_tasks.discard)
+
+    @staticmethod
+    async def _add_reactions(message: i.Message, emotes: list[str]) -> None:
+        """Adds the reactions in order, paced by the request scheduler."""
+        for emote in emotes:
+            await message_ops.add_reaction(message, emote)
+
+    async def update(self, notice: bool = True, transaction: Transaction = None) -> None:
+        """Updates the voting in the database and (shortly after) the embed.
+        If a transaction is given, the database writes are added to it instead."""
         if notice:
             regex = r"(?:\n*\+bearbeitet\+)"
             exists = re.search(regex, self.description)
@@ -81,81 +118,87 @@ class Voting():
                 subst = "\\n\\n+bearbeitet+"
                 self.description = re.sub(
                     regex, subst, self.description, flags=re.MULTILINE)
-        db.delete_data("votings", {"voting_id": self.id})
-        self._save()
-        embed = await self._get_embed()
-        message = await self.channel.fetch_message(self.message_id)
-        if message is None:
-            await self.delete()
-            return
-        await message.edit(embed=embed)
-
-    async def delete(self) -> None:
-        """Deletes the voting from the database and the embed."""
-        db.delete_data("votings", {"voting_id": self.id})
-        message = await self.channel.fetch_message(self.message_id)
-        if message is None:
-            return
-        try:
-            await message.delete()
-        except AttributeError:
-            pass
-
-    async def close(self) -> None:
-        message = await self.channel.fetch_message(self.message_id)
+        async with db.transaction(transaction) as batch:
+            if self._stored is None:
+                batch.upsert("votings", "voting_id",
+                             {"voting_id": self.id, **self._columns()})
+            else:
+                changes = {column: value for column, value in self._columns().items()
+                           if self._stored[column] != value}
+                batch.update_fields("votings", changes, {"voting_id": self.id})
+        self._remember()
+        renderer.schedule(self.client, self.channel.id, self.message_id, self._get_embed,
+                          on_missing=self._forget)
+
+    async def delete(self, transaction: Transaction = None) -> None:
+        """Deletes the voting from the database and the embed.
+        If a transaction is given, the database writes are added to it instead."""
+        async with db.transaction(transaction) as batch:
+            batch.delete("votings", {"voting_id": self.id})
+        deadlines.cancel("votings", self.id)
+        renderer.cancel(self.message_id)
+        await message_ops.delete_message(self.client, self.channel.id, self.message_id)
+
+    async def close(self, transaction: Transaction = None) -> None:
+        """Closes the voting and posts the result.
+        If a transaction is given, the database writes are added to it instead."""
+        message = await message_ops.fetch_message(self.channel, self.message_id)
         if message is None:
-            await self.delete()
-            return
-        try:
-            tie = await self._is_tie()
-        except AttributeError:
-            await self.delete()
+            await self.delete(transaction)
             return
+        # The reactions are needed, so this is the one place the message is fetched
+        tie = self._is_tie(message)
         if tie:
-            ties = await self._get_ties()
-            identifier = randint(1000, 9999)
-            identifiers = self._get_identifiers()
-            while identifier in identifiers:
-                identifier = randint(1000, 9999)
+            ties = self._get_ties(message)
             tie_description = f"[Eine Abstimmung]({message.jump_url}) ist unentschieden ausgegangen.\
                 Bitte stimme in dieser Abstimmung ab, um den Gewinner zu bestimmen."
-            voting = Voting(
-                identifier,
-                self.client,
-                owner=self.owner,
-                deadline=time() + self.wait_time,
-                description=tie_description,
-                wait_time=self.wait_time,
-                create_time=time(),
-                time_type=self.time_type,
-                count=len(ties),
-                skip_setup=True
-            )
-            await voting.create(emotes=ties)
+            # The tie-break's id is stored before it's posted, so if closing fails later
+            # on, the retry finds it instead of posting another one
+            stored = await db.get_data("votings", {"voting_id": self.id}, attribute="tie_break_id")
+            identifier = stored[0] if stored is not None else None
+            if identifier is None:
+                identifier = await db.allocate_id("votings")
+                await db.update_data("votings", "tie_break_id", identifier, {"voting_id": self.id})
+            if await db.get_data("votings", {"voting_id": identifier}, attribute="voting_id") is None:
+                voting = Voting(
+                    identifier,
+                    self.client,
+                    owner=self.owner,
+                    deadline=time() + self.wait_time,
+                    description=tie_description,
+                    wait_time=self.wait_time,
+                    create_time=time(),
+                    time_type=self.time_type,
+                    count=len(ties)
+                )
+                await voting.create(emotes=ties)
             self.description += "\n\n**Ergebnis:** Unentschieden! Bitte schaue weiter unten nach."
         else:
-            if tie is None:
-                return
             winner, winner_count = "", 0
             for reaction in message.reactions:
                 if reaction.count > winner_count:
                     winner, winner_count = reaction.emoji.name, reaction.count
             self.description += f"\n\n**Ergebnis:** {winner}"
 
-        await self.update(notice=False)
-        db.delete_data("votings", {"voting_id": self.id})
+        async with db.transaction(transaction) as batch:
+            await self.update(notice=False, transaction=batch)
+            batch.delete("votings", {"voting_id": self.id})
+        deadlines.cancel("votings", self.id)
+
+    async def _forget(self) -> None:
+        """Deletes the voting from the database, because its message is gone."""
+        await db.delete_data("votings", {"voting_id": self.id})
+        deadlines.cancel("votings", self.id)
 
     def _refresh_config(self):
         """Reloads the relevant config values."""
-        with open('config.ini', 'r') as config_file:
-            config = cp.ConfigParser()
-            config.read_file(config_file)
-            channel_id = config.getint('Voting', 'voting_channel')
-            self.channel = self.client.get_channel(channel_id)
-            if self.channel is None:
-                raise ValueError("Voting channel not found.")
-            self._voting_role_to_ping_id = config.getint(
-                'Voting', 'ping_role')
+        config = get_config()
+        channel_id = config.getint('Voting', 'voting_channel')
+        self.channel = self.client.get_channel(channel_id)
+        if self.channel is None:
+            raise ValueError("Voting channel not found.")
+        self._voting_role_to_ping_id = config.getint(
+            'Voting', 'ping_role')
 
     async def _get_embed(self) -> i.Embed:
         """Return the embed of the voting."""
@@ -182,19 +225,23 @@ class Voting():
 
     async def _get_owner_name(self) -> str:
         """Returns a string of the name of the owner of the voting."""
-        user = await self.client.fetch_user(self.owner)
-        return user.display_name
+        return await directory.get_name(self.client, self.owner)
 
     async def _get_voting_role_to_ping(self) -> i.Role:
         """Returns the role to ping."""
         role = await self.channel.guild.fetch_role(self._voting_role_to_ping_id)
         return role
 
-    def _setup(self, id: int) -> bool:
+    async def _setup(self, id: int) -> bool:
         """Sets up the voting from the database. Returns True if successful, else False."""
-        data = db.get_voting_data(id)
+        data = await db.get_voting_data(id)
         if data is None:
             return False
+        self._apply(data)
+        return True
+
+    def _apply(self, data: tuple) -> None:
+        """Sets the voting up from its data as returned by get_voting_data."""
         self.owner = data[0]
         self.message_id = data[1]
         self.deadline = data[2]
@@ -202,29 +249,30 @@ class Voting():
         self.wait_time = data[4]
         self.create_time = data[5]
         self.time_type = data[6]
-        return True
+        self._remember()
 
-    def _save(self) -> None:
-        """Saves the voting to the database."""
-        db.save_data("votings",
-                     "voting_id, user_id, message_id, deadline, description, wait_time, create_time, time_type",
-                     (self.id, self.owner, self.message_id, self.deadline, self.description,
-                      self.wait_time, self.create_time, self.time_type))
+    def _columns(self) -> dict:
+        """Returns the values of the voting by their column in the votings table."""
+        return {"user_id": self.owner, "message_id": self.message_id, "deadline": self.deadline,
+                "description": self.description, "wait_time": self.wait_time,
+                "create_time": self.create_time, "time_type": self.time_type}
 
-    async def _is_tie(self) -> bool:
-        message = await self.channel.fetch_message(self.message_id)
-        try:
-            reactions = message.reactions
-        except AttributeError:
-            await self.delete()
-            return None
-        counts = [reaction.count for reaction in reactions]
+    def _remember(self) -> None:
+        """Remembers the current values as the ones stored in the database."""
+        self._stored = self._columns()
+
+    def _save(self, transaction: Transaction) -> None:
+        """Adds saving the voting to the transaction."""
+        columns = {"voting_id": self.id, **self._columns()}
+        transaction.save("votings", ", ".join(columns), tuple(columns.values()))
+
+    def _is_tie(self, message: i.Message) -> bool:
+        counts = [reaction.count for reaction in message.reactions]
         counts.sort(reverse=True)
         tie = not counts[0] != counts[1]
         return tie
 
-    async def _get_ties(self) -> list[str]:
-        message = await self.channel.fetch_message(self.message_id)
+    def _get_ties(self, message: i.Message) -> list[str]:
         reactions = message.reactions
         counts = [reaction.count for reaction in reactions]
         counts.sort(reverse=True)
@@ -234,12 +282,6 @@ class Voting():
                 ties.append(reaction.emoji.name)
         return ties
 
-    @staticmethod
-    def _get_identifiers() -> list[int]:
-        """Returns a list of all identifiers of votings in the database."""
-        ids = db.get_data("votings", attribute="voting_id", fetch_all=True)
-        return [id[0] for id in ids]
-
     # Getters
 
     @property
@@ -1,12 +1,12 @@
 import configparser as cp
 import pkgutil
 import re
-import sqlite3 as sql
-from random import randint
 
 import interactions as i
 
-import classes.database as db
+import classes.async_database as db
+from classes import autocomplete, request_scheduler
+from classes.database import Transaction
 from classes.shop import Shop
 
 scope_ids = []
@@ -17,6 +17,31 @@ edit_menu_callback_id = re.compile(r"admin_shop_edit_id_select_\d+")
 owner_select_menu_callback_id = re.compile(r"admin_shop_owner_select_shop_\d+")
 obligatory_menu_callback_id = re.compile(r"shop_obligatory_id_select_\d+")
 voluntary_menu_callback_id = re.compile(r"shop_voluntary_id_select_\d+")
+# The conditions, custom id, placeholder and message if empty of each shop menu
+shop_menus = {
+    "approve": (({"approved": False},), "shop_approve_id_select_0",
+                "Wähle die Shops aus die du genehmigen möchtest.",
+                "Es gibt keine Shops, die noch nicht genehmigt wurden."),
+    "deny": (({"approved": True},), "shop_deny_id_select_0", "Shop-ID",
+             "Es gibt keine genehmigten Shops."),
+    "edit": ((), "admin_shop_edit_id_select_0", "Shop-ID", "Es gibt keine Shops."),
+    "delete": ((), "shop_delete_id_select_0", "Shop-ID", "Es gibt keine Shops."),
+    "owner": ((), "admin_shop_owner_select_shop_0", "Shop-ID", "Es gibt keine Shops."),
+    "obligatory": (({"obligatory": False},), "shop_obligatory_id_select_0",
+                   "Wähle die Shops aus die eine Kaufpflicht haben sollen.",
+                   "Es gibt keine Shops, welche freiwillig sind."),
+    "voluntary": (({"obligatory": True},), "shop_voluntary_id_select_0",
+                  "Wähle die Shops aus die du freiwillig machen möchtest.",
+                  "Es gibt keine Shops, mit Kaufplicht.")
+}
+multiple_shop_actions = {"approve", "deny", "obligatory", "voluntary"}
+shop_action_messages = {
+    "approve": "Shop(s) genehmigt.",
+    "deny": "Shop(s) abgelehnt.",
+    "delete": "Shop(s) gelöscht.",
+    "obligatory": "Die Shops haben nun eine Kaufplicht.",
+    "voluntary": "Die Shops sind nun freiwillig."
+}
 
 
 class AdminCommand(i.Extension):
@@ -35,13 +60,6 @@ class AdminCommand(i.Extension):
             self.shop_categories = [category.strip()
                                     for category in self.shop_categories]
 
-    @staticmethod
-    def get_shop_identifiers() -> list[str]:
-        con = sql.connect("data.db")
-        cur = con.cursor()
-        cur.execute("SELECT shop_id FROM shops")
-        return [str(ident[0]) for ident in cur.fetchall()]
-
     def reload_extensions(self) -> None:
         extension_names = [
             m.name for m in pkgutil.iter_modules(["cmds"], prefix="cmds.")]
@@ -75,63 +93,18 @@ class AdminCommand(i.Extension):
                     i.SlashCommandChoice(name="pflicht", value="obligatory"),
                     i.SlashCommandChoice(name="freiwillig", value="voluntary")
                 ]
+            ),
+            i.SlashCommandOption(
+                name="id",
+                description="Der Shop, auf den die Aktion angewendet wird.",
+                required=False,
+                type=i.OptionType.STRING,
+                autocomplete=True
             )
         ]
     )
-    async def admin_shop(self, ctx: i.SlashContext, aktion: str) -> None:
-        if aktion == "approve":
-            options = []
-            shops = db.get_data("shops", {"approved": False}, fetch_all=True,
-                                attribute="shop_id, name")
-            if shops == []:
-                await ctx.send("Es gibt keine Shops, die noch nicht genehmigt wurden.", ephemeral=True)
-                return
-            for shop_id, name in shops:
-                options.append(i.StringSelectOption(
-                    label=shop_id,
-                    description=name,
-                    value=shop_id
-                ))
-            menus = []
-            for j in range(0, len(options) // 25 + 1):
-                menus.append(
-                    i.StringSelectMenu(
-                        custom_id=f"shop_approve_id_select_{j}",
-                        placeholder="Wähle die Shops aus die du genehmigen möchtest.",
-                        *options[j*25:(j+1)*25],
-                        min_values=1,
-                        max_values=len(options[j*25:(j+1)*25])
-                    )
-                )
-            for menu in menus:
-                await ctx.send(components=menu, ephemeral=True, delete_after=25, silent=True)
-        elif aktion == "deny":
-            options = []
-            shops = db.get_data("shops", {"approved": True}, fetch_all=True,
-                                attribute="shop_id, name")
-            if shops is None or len(shops) == 0:
-                await ctx.send("Es gibt keine genehmigten Shops.", ephemeral=True)
-                return
-            for shop_id, name in shops:
-                options.append(i.StringSelectOption(
-                    label=shop_id,
-                    description=name,
-                    value=shop_id
-                ))
-            menus = []
-            for j in range(0, len(options) // 25 + 1):
-                menus.append(
-                    i.StringSelectMenu(
-                        custom_id=f"shop_deny_id_select_{j}",
-                        placeholder="Shop-ID",
-                        *options[j*25:(j+1)*25],
-                        min_values=1,
-                        max_values=len(options[j*25:(j+1)*25])
-                    )
-                )
-            for menu in menus:
-                await ctx.send(components=menu, ephemeral=True, delete_after=25, silent=True)
-        elif aktion == "create":
+    async def admin_shop(self, ctx: i.SlashContext, aktion: str, id: str = None) -> None:
+        if aktion == "create":
             components = [
                 i.InputText(
                     label="Name",
@@ -161,154 +134,89 @@ class AdminCommand(i.Extension):
                 *components
             )
             await ctx.send_modal(shop_create_modal)
-        elif aktion == "edit":
-            options = []
-            shops = db.get_data("shops", fetch_all=True,
-                                attribute="shop_id, name")
-            if shops == []:
-                await ctx.send("Es gibt keine Shops.", ephemeral=True, delete_after=5)
-                return
-            for shop_id, name in shops:
-                options.append(i.StringSelectOption(
-                    label=shop_id,
-                    description=name,
-                    value=shop_id
-                ))
-                menus = []
-            for j in range(0, len(options) // 25 + 1):
-                menus.append(
-                    i.StringSelectMenu(
-                        custom_id=f"admin_shop_edit_id_select_{j}",
-                        placeholder="Shop-ID",
-                        *options[j*25:(j+1)*25]
-                    )
-                )
-            for menu in menus:
-                await ctx.send(components=menu, ephemeral=True, delete_after=25, silent=True)
-        elif aktion == "delete":
-            options = []
-            shops = db.get_data("shops", fetch_all=True,
-                                attribute="shop_id, name")
-            if shops == []:
-                await ctx.send("Es gibt keine Shops.", ephemeral=True, delete_after=5)
-                return
-            for shop_id, name in shops:
-                options.append(i.StringSelectOption(
-                    label=shop_id,
-                    description=name,
-                    value=shop_id
-                ))
-                menus = []
-            for j in range(0, len(options) // 25 + 1):
-                menus.append(
-                    i.StringSelectMenu(
-                        custom_id=f"shop_delete_id_select_{j}",
-                        placeholder="Shop-ID",
-                        *options[j*25:(j+1)*25]
-                    )
-                )
-            for menu in menus:
-                await ctx.send(components=menu, ephemeral=True, delete_after=60, silent=True)
-        elif aktion == "owner":
-            shops = db.get_data("shops", fetch_all=True,
-                                attribute="shop_id, name")
-            if shops == []:
-                await ctx.send("Es gibt keine Shops.", ephemeral=True, delete_after=5)
-                return
-            options = []
-            for shop_id, name in shops:
-                options.append(i.StringSelectOption(
-                    label=shop_id,
-                    description=name,
-                    value=shop_id
-                ))
-            menus = []
-            for j in range(0, len(options) // 25 + 1):
-                menus.append(
-                    i.StringSelectMenu(
-                        custom_id=f"admin_shop_owner_select_shop_{j}",
-                        placeholder="Shop-ID",
-                        *options[j*25:(j+1)*25]
-                    )
-                )
-            for menu in menus:
-                await ctx.send(components=menu, ephemeral=True, delete_after=25, silent=True)
-        elif aktion == "obligatory":
-            options = []
-            shops = db.get_data("shops", {"obligatory": False}, fetch_all=True,
-                                attribute="shop_id, name")
-            if shops == []:
-                await ctx.send("Es gibt keine Shops, welche freiwillig sind.", ephemeral=True, delete_after=5)
-                return
-            for shop_id, name in shops:
-                options.append(i.StringSelectOption(
-                    label=shop_id,
-                    description=name,
-                    value=shop_id
-                ))
-            menus = []
-            for j in range(0, len(options) // 25 + 1):
-                menus.append(
-                    i.StringSelectMenu(
-                        custom_id=f"shop_obligatory_id_select_{j}",
-                        placeholder="Wähle die Shops aus die du freiwillig machen möchtest.",
-                        *options[j*25:(j+1)*25],
-                        min_values=1,
-                        max_values=len(options[j*25:(j+1)*25])
-                    )
-                )
-            for menu in menus:
-                await ctx.send(components=menu, ephemeral=True, delete_after=25, silent=True)
-        elif aktion == "voluntary":
-            options = []
-            shops = db.get_data("shops", {"obligatory": True}, fetch_all=True,
-                                attribute="shop_id, name")
-            if shops == []:
-                await ctx.send("Es gibt keine Shops, mit Kaufplicht.", ephemeral=True, delete_after=5)
-                return
-            for shop_id, name in shops:
-                options.append(i.StringSelectOption(
-                    label=shop_id,
-                    description=name,
-                    value=shop_id
-                ))
-            menus = []
-            for j in range(0, len(options) // 25 + 1):
-                menus.append(
-                    i.StringSelectMenu(
-                        custom_id=f"shop_voluntary_id_select_{j}",
-                        placeholder="Wähle die Shops aus die du freiwillig machen möchtest.",
-                        *options[j*25:(j+1)*25],
-                        min_values=1,
-                        max_values=len(options[j*25:(j+1)*25])
-                    )
-                )
-            for menu in menus:
-                await ctx.send(components=menu, ephemeral=True, delete_after=25, silent=True)
+            return
+        if id:
+            await self.shop_action(ctx, aktion, [id])
+            return
+        conditions, custom_id, placeholder, empty_message = shop_menus[aktion]
+        shops = await db.get_data("shops", *conditions, fetch_all=True,
+                                  attribute="shop_id, name")
+        if shops == []:
+            await ctx.send(empty_message, ephemeral=True, delete_after=5)
+            return
+        options = []
+        for shop_id, name in shops:
+            options.append(i.StringSelectOption(
+                label=shop_id,
+                description=name,
+                value=shop_id
+            ))
+        await autocomplete.send_select_menu(ctx, custom_id, options, placeholder,
+                                            multiple=aktion in multiple_shop_actions)
+
+    @admin_shop.autocomplete("id")
+    async def admin_shop_id_autocomplete(self, ctx: i.AutocompleteContext):
+        aktion = ctx.kwargs.get("aktion")
+        conditions = shop_menus[aktion][0] if aktion in shop_menus else ()
+        await autocomplete.send_choices(ctx, "shops", **(conditions[0] if conditions else {}))
+
+    async def shop_action(self, ctx: i.InteractionContext, aktion: str, shop_ids: list[str]) -> None:
+        """Runs the action of the shop command on the given shops."""
+        if aktion == "edit":
+            await self.send_edit_modal(ctx, shop_ids[0])
+            return
+        await ctx.defer(ephemeral=True)
+        if aktion == "owner":
+            self.transfer_data[int(ctx.author.id)] = shop_ids[0]
+            user_select = i.UserSelectMenu(
+                custom_id="admin_shop_change_owner_select",
+                placeholder="Wähle die Besitzer des Shops aus.",
+                min_values=1,
+                max_values=25
+            )
+            await ctx.send(components=[user_select], ephemeral=True, delete_after=20)
+            return
+        shops = await Shop.load_many([int(shop_id) for shop_id in shop_ids], self.client, ctx.channel)
+        if len(shops) == 0:
+            await ctx.send("Diesen Shop gibt es nicht.", ephemeral=True, delete_after=5)
+            return
+        failed = []
+        async with db.transaction() as batch:
+            for shop in shops:
+                # Only the writes of shops whose Discord requests succeeded go into the batch
+                shop_batch = Transaction()
+                try:
+                    if aktion == "approve":
+                        await shop.approve(shop_batch)
+                    elif aktion == "deny":
+                        await shop.deny(shop_batch)
+                    elif aktion == "delete":
+                        await shop.delete(shop_batch)
+                    else:
+                        shop.obligatory = aktion == "obligatory"
+                        await shop.update(shop_batch)
+                except Exception as e:
+                    print(f"Shop action {aktion} on shop {shop.id} failed: {e!r}")
+                    failed.append(shop.id)
+                    continue
+                batch.merge(shop_batch)
+        if len(failed) > 0:
+            await ctx.send(f"Bei diesen Shops hat es nicht geklappt: {', '.join(map(str, failed))}. "
+                           "Bitte versuche es später erneut.", ephemeral=True)
+            return
+        await ctx.send(shop_action_messages[aktion], ephemeral=True, delete_after=5)
 
     @i.component_callback(approve_menu_callback_id)
     async def shop_approve_id_select(self, ctx: i.ComponentContext):
-        await ctx.defer(ephemeral=True)
-        for shop_id in ctx.values:
-            shop = Shop(shop_id, self.client, ctx.channel)
-            await shop.approve()
-        await ctx.send("Shop(s) genehmigt.", ephemeral=True, delete_after=5)
+        await self.shop_action(ctx, "approve", ctx.values)
 
     @i.component_callback(delete_menu_callback_id)
     async def shop_delete_id_select(self, ctx: i.ComponentContext):
-        await ctx.defer(ephemeral=True)
-        for shop_id in ctx.values:
-            shop = Shop(shop_id, self.client, ctx.channel)
-            await shop.delete()
-        await ctx.send("Shop(s) gelöscht.", ephemeral=True, delete_after=5)
+        await self.shop_action(ctx, "delete", ctx.values)
 
     @i.component_callback(deny_menu_callback_id)
     async def shop_deny_id_select(self, ctx: i.ComponentContext):
-        await ctx.defer(ephemeral=True)
-        for shop_id in ctx.values:
-            shop = Shop(shop_id, self.client, ctx.channel)
-            await shop.deny()
-        await ctx.send("Shop(s) abgelehnt.", ephemeral=True, delete_after=5)
+        await self.shop_action(ctx, "deny", ctx.values)
 
     @i.component_callback("admin_shop_owner_select")
     async def shop_owner_select(self, ctx: i.ComponentContext):
@@ -343,10 +251,7 @@ class AdminCommand(i.Extension):
     @i.modal_callback("admin_shop_create")
     async def admin_shop_create(self, ctx: i.ModalContext, name: str, offer: str,
                                 location: str):
-        identifier = str(randint(1000, 9999))
-        identifiers = self.get_shop_identifiers()
-        while identifier in identifiers:
-            identifier = str(randint(1000, 9999))
+        identifier = await db.allocate_id("shops")
         self.transfer_data[int(ctx.author.id)] = Shop(
             identifier,
             self.client,
@@ -354,8 +259,7 @@ class AdminCommand(i.Extension):
             name=name,
             offer=offer,
             location=location,
-            approved=True,
-            skip_setup=True
+            approved=True
         )
         user_select = i.UserSelectMenu(
             custom_id="admin_shop_owner_select",
@@ -367,8 +271,16 @@ class AdminCommand(i.Extension):
 
     @i.component_callback(edit_menu_callback_id)
     async def shop_edit_id_select(self, ctx: i.ComponentContext):
-        self.transfer_data[int(ctx.author.id)] = ctx.values[0]
-        shop = Shop(ctx.values[0], self.client, ctx.channel)
+        await self.shop_action(ctx, "edit", ctx.values)
+
+    async def send_edit_modal(self, ctx: i.InteractionContext, shop_id: str) -> None:
+        """Sends the modal to edit the shop."""
+        try:
+            shop = await Shop.load(int(shop_id), self.client, ctx.channel)
+        except ValueError:
+            await ctx.send("Diesen Shop gibt es nicht.", ephemeral=True, delete_after=5)
+            return
+        self.transfer_data[int(ctx.author.id)] = shop.id
         components = [
             i.InputText(
                 label="Name",
@@ -405,7 +317,7 @@ class AdminCommand(i.Extension):
     @i.modal_callback("admin_shop_edit")
     async def admin_shop_edit(self, ctx: i.ModalContext, name: str, offer: str,
                               location: str):
-        shop = Shop(self.transfer_data[int(
+        shop = await Shop.load(self.transfer_data[int(
             ctx.author.id)], self.client, ctx.channel)
         shop.name = name
         shop.offer = offer
@@ -415,20 +327,12 @@ class AdminCommand(i.Extension):
 
     @i.component_callback(owner_select_menu_callback_id)
     async def admin_shop_owner_select_shop(self, ctx: i.ComponentContext):
-        await ctx.defer(ephemeral=True)
-        self.transfer_data[int(ctx.author.id)] = ctx.values[0]
-        user_select = i.UserSelectMenu(
-            custom_id="admin_shop_change_owner_select",
-            placeholder="Wähle die Besitzer des Shops aus.",
-            min_values=1,
-            max_values=25
-        )
-        await ctx.send(components=[user_select], ephemeral=True, delete_after=20)
+        await self.shop_action(ctx, "owner", ctx.values)
 
     @i.component_callback("admin_shop_change_owner_select")
     async def admin_shop_owner_select(self, ctx: i.ComponentContext):
         await ctx.defer(ephemeral=True)
-        shop = Shop(self.transfer_data[int(
+        shop = await Shop.load(self.transfer_data[int(
             ctx.author.id)], self.client, ctx.channel)
         owners = []
         for user in ctx.values:
@@ -439,21 +343,11 @@ class AdminCommand(i.Extension):
 
     @i.component_callback(obligatory_menu_callback_id)
     async def shop_obligatory_id_select(self, ctx: i.ComponentContext):
-        await ctx.defer(ephemeral=True)
-        for shop_id in ctx.values:
-            shop = Shop(shop_id, self.client, ctx.channel)
-            shop.obligatory = True
-            await shop.update()
-        await ctx.send("Die Shops haben nun eine Kaufplicht.", ephemeral=True, delete_after=5)
+        await self.shop_action(ctx, "obligatory", ctx.values)
 
     @i.component_callback(voluntary_menu_callback_id)
     async def shop_voluntary_id_select(self, ctx: i.ComponentContext):
-        await ctx.defer(ephemeral=True)
-        for shop_id in ctx.values:
-            shop = Shop(shop_id, self.client, ctx.channel)
-            shop.obligatory = False
-            await shop.update()
-        await ctx.send("Die Shops sind nun freiwillig.", ephemeral=True, delete_after=5)
+        await self.shop_action(ctx, "voluntary", ctx.values)
 
     @admin_base.subcommand(
         sub_cmd_name="config",
@@ -498,3 +392,16 @@ class AdminCommand(i.Extension):
         self.refresh_config()
         self.reload_extensions()
         await ctx.send("Config bearbeitet.", ephemeral=True, delete_after=5)
+
+    @admin_base.subcommand(
+        sub_cmd_name="anfragen",
+        sub_cmd_description="Zeigt die Warteschlange der Anfragen an Discord."
+    )
+    async def admin_requests(self, ctx: i.SlashContext) -> None:
+        stats = request_scheduler.scheduler.stats()
+        lines = [f"**Laufend:** {stats['running']}"]
+        for name, title in (("interactive", "Interaktiv"), ("background", "Hintergrund")):
+            priority_stats = stats[name]
+            lines.append(f"**{title}:** {priority_stats['queued']} wartend, {priority_stats['done']} erledigt, "
+                         f"Wartezeit Ø {priority_stats['average_wait']:.2f}s / max. {priority_stats['max_wait']:.2f}s")
+        await ctx.send("\n".join(lines), ephemeral=True)
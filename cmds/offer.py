@@ -1,11 +1,12 @@
 import configparser as cp
-import sqlite3 as sql
-from random import randint
 from time import localtime, strftime, time
 
 import interactions as i
 
-import classes.database as db
+import classes.async_database as db
+from classes import message_ops
+from classes.deadline_scheduler import deadlines
+from classes import autocomplete
 
 scope_ids = []
 
@@ -23,13 +24,7 @@ class OfferCommand(i.Extension):
             scope_ids = config.get('General', 'servers').split(',')
             self.role_to_ping_id = config.getint(
                 'Offer', 'ping_role')
-
-    @staticmethod
-    def get_identifiers() -> list[str]:
-        con = sql.connect("data.db")
-        cur = con.cursor()
-        cur.execute("SELECT offer_id FROM offers")
-        return [str(ident[0]) for ident in cur.fetchall()]
+            self.offer_channel_id = config.getint('Offer', 'offer_channel')
 
     @i.slash_command(
         name="angebot",
@@ -55,22 +50,20 @@ class OfferCommand(i.Extension):
                         value="edit"
                     )
                 ]
+            ),
+            i.SlashCommandOption(
+                name="id",
+                description="Das Angebot, das du bearbeiten oder löschen möchtest.",
+                type=i.OptionType.STRING,
+                required=False,
+                autocomplete=True
             )
         ]
     )
-    async def offer(self, ctx: i.SlashContext, aktion: str):
+    async def offer(self, ctx: i.SlashContext, aktion: str, id: str = None):
         if aktion == "create":
-            if db.get_data("users", {"user_id": str(ctx.author.id)}) is None:
-                db.save_data("users", "user_id, offers_count, shop_count",
-                             (int(ctx.author.id), 0, 0))
-
-            offer_count = db.get_data(
-                "users", {"user_id": int(ctx.author.id)}, attribute="offers_count")[0]
-            if offer_count is None:
-                offer_count = 0
-                db.save_data("users", "user_id, offers_count, shop_count",
-                             (int(ctx.author.id), 0, 0))
-            elif int(offer_count) >= 3:
+            offer_count, _ = await db.get_counts(int(ctx.author.id))
+            if offer_count >= 3:
                 await ctx.send("Du hast bereits 3 Angebote erstellt.", ephemeral=True)
                 return
 
@@ -113,9 +106,23 @@ class OfferCommand(i.Extension):
                 *components
             )
             await ctx.send_modal(create_modal)
+        elif aktion == "delete" and id:
+            await ctx.defer(ephemeral=True)
+            failed = await self.delete_offers(ctx, [id])
+            if failed is None:
+                await ctx.send("Du hast kein Angebot mit dieser ID.", ephemeral=True)
+            elif len(failed) > 0:
+                await ctx.send("Das Angebot konnte nicht gelöscht werden. Bitte versuche es später erneut.",
+                               ephemeral=True)
+            else:
+                await ctx.send("Das Angebot wurde gelöscht.", ephemeral=True)
+        elif aktion == "edit" and id:
+            await self.send_edit_modal(ctx, id)
         elif aktion == "delete":
             options = []
-            for offer in db.get_data("offers", {"user_id": str(ctx.author.id)}, attribute="offer_id, title", fetch_all=True):
+            offers = await db.get_data("offers", {"user_id": str(ctx.author.id)},
+                                       attribute="offer_id, title", fetch_all=True)
+            for offer in offers:
                 options.append(
                     i.StringSelectOption(
                         label=offer[0],
@@ -126,17 +133,14 @@ class OfferCommand(i.Extension):
             if len(options) == 0:
                 await ctx.send("Du hast keine Angebote, die du löschen kannst.", ephemeral=True)
                 return
-            delete_selectmenu = i.StringSelectMenu(
-                custom_id="delete_offer_menu",
-                placeholder="Wähle ein Angebot aus",
-                *options,
-                min_values=1,
-                max_values=len(options)
-            )
-            await ctx.send("Wähle die Angebote aus, die du löschen möchtest.", components=delete_selectmenu, ephemeral=True)
+            await autocomplete.send_select_menu(ctx, "delete_offer_menu", options, "Wähle ein Angebot aus",
+                                                multiple=True, delete_after=None,
+                                                content="Wähle die Angebote aus, die du löschen möchtest.")
         elif aktion == "edit":
             options = []
-            for offer in db.get_data("offers", {"user_id": str(ctx.author.id)}, attribute="offer_id, title", fetch_all=True):
+            offers = await db.get_data("offers", {"user_id": str(ctx.author.id)},
+                                       attribute="offer_id, title", fetch_all=True)
+            for offer in offers:
                 options.append(
                     i.StringSelectOption(
                         label=offer[0],
@@ -147,21 +151,17 @@ class OfferCommand(i.Extension):
             if len(options) == 0:
                 await ctx.send("Es gibt keine Angebote, die du bearbeiten kannst.", ephemeral=True)
                 return
-            edit_selectmenu = i.StringSelectMenu(
-                custom_id="edit_offer_menu",
-                placeholder="Wähle ein Angebot aus",
-                *options,
-                min_values=1,
-                max_values=1
-            )
-            await ctx.send("Wähle das Angebot aus, das du bearbeiten möchtest.", components=edit_selectmenu, ephemeral=True)
+            await autocomplete.send_select_menu(ctx, "edit_offer_menu", options, "Wähle ein Angebot aus",
+                                                delete_after=None,
+                                                content="Wähle das Angebot aus, das du bearbeiten möchtest.")
+
+    @offer.autocomplete("id")
+    async def offer_id_autocomplete(self, ctx: i.AutocompleteContext):
+        await autocomplete.send_choices(ctx, "offers", owner=int(ctx.author.id))
 
     @i.modal_callback("mod_create_offer")
     async def create_offer_respone(self, ctx: i.SlashContext, title: str, price: str, text: str, deadline: str, image_url: str = None):
-        identifier_list = self.get_identifiers()
-        identifier = randint(1000, 9999)
-        while identifier in identifier_list:
-            identifier = randint(1000, 9999)
+        identifier = await db.allocate_id("offers")
 
         if int(deadline) < 1:
             deadline = 1
@@ -186,36 +186,62 @@ class OfferCommand(i.Extension):
         server: i.Guild = ctx.guild
         role_to_ping: i.Role = server.get_role(
             self.role_to_ping_id)
-        sent_message = await channel.send(content=role_to_ping.mention, embeds=app_embed)
+        sent_message = await message_ops.send_message(channel, content=role_to_ping.mention, embeds=app_embed)
 
-        db.save_data("offers", "offer_id, title, user_id, price, description, deadline, message_id",
-                     (identifier, title, int(ctx.author.id), price, text, numeric_end_time, int(sent_message.id)))
-        offer_count = int(db.get_data(
-            "users", {"user_id": int(ctx.author.id)}, attribute="offers_count")[0])
-        db.update_data("users", "offers_count", offer_count +
-                       1, {"user_id": int(ctx.author.id)})
+        await db.save_data("offers", "offer_id, title, user_id, price, description, deadline, message_id",
+                           (identifier, title, int(ctx.author.id), price, text, numeric_end_time,
+                            int(sent_message.id)))
+        deadlines.schedule("offers", identifier, numeric_end_time)
         await ctx.send("Das Angebot wurde entgegen genommen.", ephemeral=True)
 
     @i.component_callback("delete_offer_menu")
     async def delete_offer_response(self, ctx: i.SlashContext):
         await ctx.defer(ephemeral=True)
-        offer_channel: i.GuildText = ctx.channel
-        for id in ctx.values:
-            message_id = db.get_data(
-                "offers", {"offer_id": id}, attribute="message_id")[0]
-            offer_message: i.Message = await offer_channel.fetch_message(message_id)
-            await offer_message.delete()
-            db.delete_data("offers", {"offer_id": id})
-            offer_count = int(db.get_data(
-                "users", {"user_id": int(ctx.author.id)}, attribute="offers_count")[0])
-            db.update_data("users", "offers_count", offer_count - 1,
-                           {"user_id": int(ctx.author.id)})
+        failed = await self.delete_offers(ctx, ctx.values)
+        if failed:
+            await ctx.send(f"Diese Angebote konnten nicht gelöscht werden: {', '.join(map(str, failed))}. "
+                           "Bitte versuche es später erneut.", ephemeral=True)
+            return
         await ctx.send("Die Angebote wurden gelöscht.", ephemeral=True)
 
+    async def delete_offers(self, ctx: i.InteractionContext, offer_ids: list[str]) -> list[int] | None:
+        """Deletes the offers of the author with the given ids. An offer is only removed
+        from the database once its message is gone.
+        Returns the ids of the offers whose message couldn't be deleted, or None if none
+        of them belongs to the author."""
+        offers = await db.get_data("offers", {"offer_id": list(offer_ids), "user_id": int(ctx.author.id)},
+                                   attribute="offer_id, message_id", fetch_all=True)
+        if len(offers) == 0:
+            return None
+        deleted, failed = [], []
+        for offer_id, message_id in offers:
+            try:
+                # False means the message is gone already, which is fine as well
+                await message_ops.delete_message(self.client, self.offer_channel_id, message_id)
+            except Exception as e:
+                print(f"Deleting the message of offer {offer_id} failed: {e!r}")
+                failed.append(offer_id)
+                continue
+            deleted.append(offer_id)
+        if len(deleted) > 0:
+            async with db.transaction() as batch:
+                batch.delete("offers", {"offer_id": deleted})
+        for offer_id in deleted:
+            deadlines.cancel("offers", offer_id)
+        return failed
+
     @i.component_callback("edit_offer_menu")
     async def edit_offer_response(self, ctx: i.ComponentContext):
-        title, text = db.get_data(
-            "offers", {"offer_id": ctx.values[0]}, attribute="title, description", fetch_all=True)[0]
+        await self.send_edit_modal(ctx, ctx.values[0])
+
+    async def send_edit_modal(self, ctx: i.InteractionContext, offer_id: str) -> None:
+        """Sends the modal to edit the offer, if it belongs to the author."""
+        offer = await db.get_data("offers", {"offer_id": offer_id, "user_id": int(ctx.author.id)},
+                                  attribute="title, description")
+        if offer is None:
+            await ctx.send("Du hast kein Angebot mit dieser ID.", ephemeral=True)
+            return
+        title, text = offer
         components = [
             i.InputText(
                 style=i.TextStyles.SHORT,
@@ -236,8 +262,7 @@ class OfferCommand(i.Extension):
                 label="ID",
                 custom_id="id",
                 required=True,
-                max_length=4,
-                value=ctx.values[0]
+                value=str(offer_id)
             )
         ]
         edit_modal = i.Modal(
@@ -259,24 +284,25 @@ class OfferCommand(i.Extension):
                 f"Oops, etwas ist schief gegangen! Fehler: {e}", ephemeral=True)
             return
 
-        if id not in self.get_identifiers():
+        offer_owner_id = await db.get_data(
+            "offers", {"offer_id": id}, attribute="user_id")
+        if offer_owner_id is None:
             await ctx.send("Diese ID existiert nicht!", ephemeral=True)
             return
-        offer_owner_id = db.get_data(
-            "offers", {"offer_id": id}, attribute="user_id")[0]
+        offer_owner_id = offer_owner_id[0]
         if str(offer_owner_id) != str(ctx.author.id):
             await ctx.send("Du bist nicht berechtigt dieses Angebot zu bearbeiten!",
                            ephemeral=True)
             return
-        message_id, price = db.get_data(
-            "offers", {"offer_id": id}, attribute="message_id, price", fetch_all=True)[0]
-        offer_channel: i.GuildText = ctx.channel
-        offer_message: i.Message = await offer_channel.fetch_message(message_id)
+        message_id, price = (await db.get_data(
+            "offers", {"offer_id": id}, attribute="message_id, price", fetch_all=True))[0]
+        offer_channel: i.GuildText = self.client.get_channel(self.offer_channel_id)
+        offer_message: i.Message = await message_ops.fetch_message(offer_channel, message_id)
         message_embed: i.Embed = offer_message.embeds[0]
         edited_text = f"{text}\n\n**Preis:** {price}\n*bearbeitet *"
         message_embed.title = title
         message_embed.description = edited_text
-        await offer_message.edit(embeds=message_embed)
-        db.update_data("offers", "title", title, {"offer_id": id})
-        db.update_data("offers", "description", text, {"offer_id": id})
+        await message_ops.edit_message(self.client, offer_channel.id, message_id, embeds=message_embed)
+        await db.update_data("offers", "title", title, {"offer_id": id})
+        await db.update_data("offers", "description", text, {"offer_id": id})
         await ctx.send("Das Angebot wurde bearbeitet.", ephemeral=True)
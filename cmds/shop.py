@@ -1,11 +1,10 @@
 import configparser as cp
-from random import randint
-import classes.database as db
+import classes.async_database as db
+from classes import autocomplete
 from classes.shop import Shop
-import sqlite3 as sql
+from classes.shop_pages import ShopPages, page_button_callback_id
 
 import interactions as i
-from interactions.ext.paginators import Paginator
 
 scope_ids = []
 
@@ -31,6 +30,10 @@ class ShopCommand(i.Extension):
         global scope_ids
         scope_ids = config.get('General', 'servers').split(',')
         self.transfer_data = {}
+        # The searches by the id of their message, so a user can page through several at once.
+        # Only the latest ones are kept, older messages say the search expired.
+        self.shop_pages: dict[int, ShopPages] = {}
+        self.max_shop_pages = 256
 
     def refresh_components(self):
         options = []
@@ -54,25 +57,16 @@ class ShopCommand(i.Extension):
         )
 
     @staticmethod
-    def get_identifiers() -> list[str]:
-        con = sql.connect("data.db")
-        cur = con.cursor()
-        cur.execute("SELECT shop_id FROM shops")
-        return [str(ident[0]) for ident in cur.fetchall()]
-
-    @staticmethod
-    def get_shop_ids_select_options(user_id: int) -> list[i.StringSelectOption]:
+    async def get_shop_ids_select_options(user_id: int) -> list[i.StringSelectOption]:
         options = []
-        shops = db.get_data("shops", fetch_all=True,
-                            attribute="shop_id, name, owners")
+        shops = await db.get_user_shops(user_id)
         for shop in shops:
-            if str(user_id) in shop[2]:
-                option = i.StringSelectOption(
-                    label=str(shop[0]),
-                    value=str(shop[0]),
-                    description=shop[1]
-                )
-                options.append(option)
+            option = i.StringSelectOption(
+                label=str(shop[0]),
+                value=str(shop[0]),
+                description=shop[1]
+            )
+            options.append(option)
         return options
 
     @i.component_callback("shop_abort")
@@ -114,11 +108,23 @@ class ShopCommand(i.Extension):
                         value="search"
                     )
                 ]
+            ),
+            i.SlashCommandOption(
+                name="suchbegriff",
+                description="Wonach du beim Durchsuchen suchst (Name, Angebot oder Ort).",
+                type=i.OptionType.STRING,
+                required=False
+            ),
+            i.SlashCommandOption(
+                name="id",
+                description="Der Shop, den du bearbeiten oder löschen möchtest.",
+                type=i.OptionType.STRING,
+                required=False,
+                autocomplete=True
             )
-
         ]
     )
-    async def shop(self, ctx: i.SlashContext, aktion: str):
+    async def shop(self, ctx: i.SlashContext, aktion: str, suchbegriff: str = None, id: str = None):
         if aktion == "create":
             self.transfer_data[int(ctx.author.id)] = {}
             row1 = i.ActionRow(self.categorie_selectmenu)
@@ -126,44 +132,42 @@ class ShopCommand(i.Extension):
             sent_message = await ctx.send(components=[row1, row2], ephemeral=True, delete_after=20)
             self.transfer_data[int(ctx.author.id)]["message_id"] = int(
                 sent_message.id)
+        elif aktion == "edit" and id:
+            shop = await self.get_own_shop(ctx, id)
+            if shop is not None:
+                await self.send_edit_modal(ctx, shop)
         elif aktion == "edit":
-            options = self.get_shop_ids_select_options(
+            options = await self.get_shop_ids_select_options(
                 int(ctx.user.id))
-            menus = []
-            for j in range(0, len(options) // 25 + 1):
-                menus.append(
-                    i.StringSelectMenu(
-                        custom_id=f"shop_edit_id_select_{j}",
-                        placeholder="Shop-ID",
-                        *options[j*25:(j+1)*25]
-                    )
-                )
-            await ctx.send("Bitte wähle einen Shop aus, den du bearbeiten möchtest:",
-                           ephemeral=True, delete_after=10)
-            for menu in menus:
-                await ctx.send(components=menu, ephemeral=True, delete_after=25, silent=True)
+            if len(options) == 0:
+                await ctx.send("Du hast keine Shops, die du bearbeiten könntest!", ephemeral=True,
+                               delete_after=5)
+                return
+            await autocomplete.send_select_menu(ctx, "shop_edit_id_select_0", options, "Shop-ID",
+                                                content="Bitte wähle einen Shop aus, den du bearbeiten möchtest:")
+        elif aktion == "delete" and id:
+            shop = await self.get_own_shop(ctx, id)
+            if shop is None:
+                return
+            await shop.delete()
+            await ctx.send(content="Der Shop wurde gelöscht.", ephemeral=True, delete_after=5)
         elif aktion == "delete":
-            options = self.get_shop_ids_select_options(
+            options = await self.get_shop_ids_select_options(
                 int(ctx.user.id))
             if len(options) == 0:
                 await ctx.send("Du hast keine Shops, die du löschen könntest!", ephemeral=True,
                                delete_after=5)
                 return
-            menus = []
-            for j in range(0, len(options) // 25 + 1):
-                menus.append(
-                    i.StringSelectMenu(
-                        custom_id=f"shop_delete_id_select_{j}",
-                        placeholder="Shop-ID",
-                        *options[j*25:(j+1)*25],
-                        min_values=1,
-                        max_values=len(options[j*25:(j+1)*25])
-                    )
-                )
-            await ctx.send("Bitte wähle einen Shop aus, den du löschen möchtest:",
-                           ephemeral=True, delete_after=10)
-            for menu in menus:
-                await ctx.send(components=menu, ephemeral=True, delete_after=25, silent=True)
+            await autocomplete.send_select_menu(ctx, "shop_delete_id_select_0", options, "Shop-ID",
+                                                multiple=True,
+                                                content="Bitte wähle einen Shop aus, den du löschen möchtest:")
+        elif aktion == "search" and suchbegriff:
+            await ctx.defer(ephemeral=True)
+            shop_ids = await db.search_shops(suchbegriff)
+            if len(shop_ids) == 0:
+                await ctx.send("Es wurden keine passenden Shops gefunden.", ephemeral=True)
+                return
+            await self.send_shops(ctx, ShopPages(self.client, ctx.channel, shop_ids=shop_ids))
         elif aktion == "search":
             options = [i.StringSelectOption(label=category, value=category)
                        for category in self.categories]
@@ -177,33 +181,48 @@ class ShopCommand(i.Extension):
             await ctx.send("Bitte wähle die Kategorien aus, nach denen du suchen möchtest:",
                            components=category_selectmenu, ephemeral=True, delete_after=15)
 
+    @shop.autocomplete("id")
+    async def shop_id_autocomplete(self, ctx: i.AutocompleteContext):
+        await autocomplete.send_choices(ctx, "shops", owner=int(ctx.author.id))
+
+    async def get_own_shop(self, ctx: i.InteractionContext, shop_id: str) -> Shop | None:
+        """Returns the shop if it exists and the author owns it, else tells them why not."""
+        try:
+            shop = await Shop.load(int(shop_id), self.client, ctx.channel)
+        except ValueError:
+            await ctx.send(content="Diesen Shop gibt es nicht.", ephemeral=True, delete_after=5)
+            return None
+        if int(ctx.author.id) not in shop.owners:
+            await ctx.send(content="Du kannst nur deine eigenen Shops bearbeiten!",
+                           ephemeral=True, delete_after=5)
+            return None
+        return shop
+
     @ i.component_callback("shop_delete_id_select")
     async def shop_delete_id_select(self, ctx: i.ComponentContext):
-        for shop_id in ctx.values:
-            await Shop(int(shop_id), self.client, ctx.channel).delete()
+        shops = await Shop.load_many([int(shop_id) for shop_id in ctx.values], self.client, ctx.channel)
+        async with db.transaction() as batch:
+            for shop in shops:
+                await shop.delete(batch)
         await ctx.send(content="Die Shops wurden gelöscht.", ephemeral=True, delete_after=5)
 
     @ i.component_callback("shop_delete_id_select_0")
     async def shop_delete_id_select_0(self, ctx: i.ComponentContext):
         await self.shop_delete_id_select(ctx)
 
-    @ i.component_callback("shop_delete_id_select_1")
-    async def shop_delete_id_select_1(self, ctx: i.ComponentContext):
-        await self.shop_delete_id_select(ctx)
-
-    @ i.component_callback("shop_delete_id_select_2")
-    async def shop_delete_id_select_2(self, ctx: i.ComponentContext):
-        await self.shop_delete_id_select(ctx)
-
     @ i.component_callback("shop_edit_id_select")
     async def shop_edit_id_select(self, ctx: i.ComponentContext):
         shop_id = ctx.values[0]
-        shop = Shop(int(shop_id), self.client, ctx.channel)
+        shop = await Shop.load(int(shop_id), self.client, ctx.channel)
+        await self.send_edit_modal(ctx, shop)
+
+    async def send_edit_modal(self, ctx: i.InteractionContext, shop: Shop) -> None:
+        """Sends the modal to edit the shop."""
         components = [
             i.InputText(
                 custom_id="id",
                 label="ID (NICHT ÄNDERN!)",
-                value=shop_id,
+                value=str(shop.id),
                 style=i.TextStyles.SHORT,
                 required=True
             ),
@@ -244,18 +263,10 @@ class ShopCommand(i.Extension):
     async def shop_edit_id_select_0(self, ctx: i.ComponentContext):
         await self.shop_edit_id_select(ctx)
 
-    @ i.component_callback("shop_edit_id_select_1")
-    async def shop_edit_id_select_1(self, ctx: i.ComponentContext):
-        await self.shop_edit_id_select(ctx)
-
-    @ i.component_callback("shop_edit_id_select_2")
-    async def shop_edit_id_select_2(self, ctx: i.ComponentContext):
-        await self.shop_edit_id_select(ctx)
-
     @ i.modal_callback("shop_edit_modal")
     async def shop_edit_modal(self, ctx: i.ComponentContext, id: str, name: str, offer: str, location: str):
         try:
-            shop = Shop(int(id), self.client, ctx.channel)
+            shop = await Shop.load(int(id), self.client, ctx.channel)
         except ValueError:
             await ctx.send(content="Du hast die ID verändert... Warum bist du so?",
                            ephemeral=True, delete_after=5)
@@ -273,14 +284,7 @@ class ShopCommand(i.Extension):
     @ i.component_callback("categorie_select")
     async def categorie_select(self, ctx: i.ComponentContext):
         value = ctx.values
-        shop_count = db.get_data(
-            "users", {"user_id": int(ctx.author.id)}, attribute="shop_count")
-        if shop_count is None:
-            db.save_data("users", "user_id, offers_count, shop_count",
-                         (int(ctx.author.id), 0, 0))
-            shop_count = 0
-        else:
-            shop_count = shop_count[0]
+        _, shop_count = await db.get_counts(int(ctx.author.id))
         if (
             not value[0] in self.categories_excluded_from_limit
             and shop_count >= self.count_limit
@@ -294,12 +298,8 @@ class ShopCommand(i.Extension):
             await ctx.send(content="Du hast bereits die maximale Anzahl an Shops erreicht.",
                            ephemeral=True, delete_after=5)
             return
-        identifier = str(randint(1000, 9999))
-        identifiers = self.get_identifiers()
-        while identifier in identifiers:
-            identifier = str(randint(1000, 9999))
-        shop = Shop(int(identifier), self.client, ctx.channel,
-                    skip_setup=True,
+        identifier = await db.allocate_id("shops")
+        shop = Shop(identifier, self.client, ctx.channel,
                     category=value[0]
                     )
         try:
@@ -358,18 +358,42 @@ class ShopCommand(i.Extension):
     @i.component_callback("shop_search_category_select")
     async def shop_search_category_select(self, ctx: i.ComponentContext):
         await ctx.defer(ephemeral=True)
-        value = ctx.values
-        embeds = []
-        shops = db.get_data("shops", {"category": value, "approved": True}, fetch_all=True,
-                            attribute="shop_id")
-        for shop_id in shops:
-            shop = Shop(int(shop_id[0]), self.client, ctx.channel)
-            embed = await shop.get_embed()
-            embeds.append(embed)
-        paginator = Paginator.create_from_embeds(self.client, *embeds)
-        paginator.show_select_menu = True
-        await paginator.send(ctx, **{"ephemeral": True})
-        await ctx.send(content="Have fun!", delete_after=3, ephemeral=True)
+        await self.send_shops(ctx, ShopPages(self.client, ctx.channel, categories=ctx.values))
+
+    async def send_shops(self, ctx: i.InteractionContext, pages: ShopPages) -> None:
+        """Sends the first page of the shops, the others are rendered when they are shown."""
+        shop_id = await pages.get_shop_id("first")
+        if shop_id is None:
+            await ctx.send(content="Es wurden keine Shops gefunden.", ephemeral=True, delete_after=5)
+            return
+        try:
+            page = await pages.render(shop_id)
+        except ValueError:
+            # The shop was deleted in the meantime
+            await ctx.send(content="Dieser Shop existiert nicht mehr, bitte suche erneut.",
+                           ephemeral=True, delete_after=5)
+            return
+        message = await ctx.send(**page, ephemeral=True)
+        self.shop_pages[int(message.id)] = pages
+        while len(self.shop_pages) > self.max_shop_pages:
+            del self.shop_pages[next(iter(self.shop_pages))]
+
+    @i.component_callback(page_button_callback_id)
+    async def shop_page_button(self, ctx: i.ComponentContext):
+        pages = self.shop_pages.get(int(ctx.message.id))
+        if pages is None:
+            await ctx.send(content="Diese Suche ist abgelaufen, bitte suche erneut.",
+                           ephemeral=True, delete_after=5)
+            return
+        step, shop_id, page = page_button_callback_id.fullmatch(ctx.custom_id).groups()
+        try:
+            shop_id = await pages.get_shop_id(step, int(shop_id))
+            if shop_id is None:
+                raise ValueError("Shop not found.")
+            await ctx.edit_origin(**await pages.render(shop_id, await pages.get_page(step, int(page))))
+        except ValueError:
+            await ctx.send(content="Dieser Shop existiert nicht mehr, bitte suche erneut.",
+                           ephemeral=True, delete_after=5)
 
     @i.component_callback("shop_create_user_select")
     async def shop_create_user_select(self, ctx: i.ComponentContext):
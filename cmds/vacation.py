@@ -1,10 +1,11 @@
 import configparser as cp
 from datetime import datetime
-from time import time
 
 import interactions as i
 
-from classes.database import save_data
+from classes import message_ops, request_scheduler
+from classes.async_database import save_data
+from classes.deadline_scheduler import DEADLINE_OFFSETS, deadlines
 
 user_select_data = {}
 scope_ids = []
@@ -19,28 +20,61 @@ for r in config.get('Vacation', 'reasons').split('|'):
 
 class VacationCommand(i.Extension):
     def __init__(self, client):
-        self.elevatedUsers = {"updateTime": time(), "users": set()}
+        # The ids of the members with a DM role, kept up to date by the member events
+        self.elevatedUsers: set[int] = set()
+        self.dmRoleIds = {int(role_id)
+                          for role_id in config.get('Vacation', 'dm_roles').split(',')}
         self.client = client
+        if self.client.is_ready:
+            # The extension was reloaded, so Startup won't come again
+            self._rebuildElevatedUsers()
 
-    def _getDMUsers(self, ctx: i.SlashContext) -> list[i.Member]:
-        """Searches all users of a guild that have the DM role and returns them as a list.
-        It caches the list so we don't pull it every time."""
-        dm_roles: list[i.Role] = []
-        for role_id in config.get('Vacation', 'dm_roles').split(','):
-            dm_roles.append(ctx.guild.get_role(int(role_id)))
+    def _rebuildElevatedUsers(self) -> None:
+        """Collects all members with a DM role from the guilds."""
+        elevated_users = set()
+        for guild in self.client.guilds:
+            for role_id in self.dmRoleIds:
+                role = guild.get_role(role_id)
+                if role is not None:
+                    elevated_users.update(int(member.id) for member in role.members)
+        self.elevatedUsers = elevated_users
+
+    def _updateElevatedUser(self, member: i.Member) -> None:
+        """Adds or removes the member, depending on whether they have a DM role."""
+        if any(int(role.id) in self.dmRoleIds for role in member.roles):
+            self.elevatedUsers.add(int(member.id))
+        else:
+            self.elevatedUsers.discard(int(member.id))
+
+    @i.listen(i.events.Startup)
+    async def on_startup(self):
+        self._rebuildElevatedUsers()
+
+    @i.listen(i.events.MemberAdd)
+    async def on_member_add(self, event: i.events.MemberAdd):
+        self._updateElevatedUser(event.member)
 
-        dm: set[i.Member] = {
-            member for role in dm_roles for member in role.members}
+    @i.listen(i.events.MemberUpdate)
+    async def on_member_update(self, event: i.events.MemberUpdate):
+        self._updateElevatedUser(event.after)
 
-        self.elevatedUsers["updateTime"] = time()
-        self.elevatedUsers["users"] = dm
-        return dm
+    @i.listen(i.events.MemberRemove)
+    async def on_member_remove(self, event: i.events.MemberRemove):
+        self.elevatedUsers.discard(int(event.member.id))
+
+    @i.listen(i.events.RoleDelete)
+    async def on_role_delete(self, event: i.events.RoleDelete):
+        if int(event.id) in self.dmRoleIds:
+            self._rebuildElevatedUsers()
+
+    def _getDMUsers(self, ctx: i.SlashContext) -> list[i.Member]:
+        """Returns all members of the guild that have a DM role."""
+        members = (ctx.guild.get_member(user_id) for user_id in self.elevatedUsers)
+        return [member for member in members if member is not None]
 
     def _isUserElevated(self, user: i.Member) -> bool:
         """Checks if a user is elevated and returns True if they are."""
-        if time() - self.elevatedUsers["updateTime"] > 300 or len(self.elevatedUsers["users"]) == 0:
-            self.elevatedUsers["users"] = self._getDMUsers(user)
-        return user in self.elevatedUsers["users"]
+        return int(user.id) in self.elevatedUsers
 
     @i.slash_command(name="abwesenheit",
                      description="Der Command für das Eintragen von Abwesenheiten.",
@@ -84,6 +118,8 @@ class VacationCommand(i.Extension):
         except ValueError:
             await ctx.send("Das Datum muss im Format dd.mm.yyyy sein!", ephemeral=True, delete_after=10)
             return
+        # Sending the DMs can take longer than Discord waits for an answer
+        await ctx.defer(ephemeral=True)
 
         embed = i.Embed(title="Abwesenheitsinfo",
                         description=f"**Wer?**\n{nutzer.mention}",
@@ -97,22 +133,26 @@ class VacationCommand(i.Extension):
                         ])
         guild_channel = ctx.guild.get_channel(
             int(config.get('Vacation', 'guild_channel')))
-        guild_message = await guild_channel.send(embed=embed)
-
-        embed.fields.append(i.EmbedField(
-            name="Ersteller", value=ctx.author.display_name))
-        for member in self._getDMUsers(ctx):
-            dm_channel: i.DM = await member.fetch_dm()
-            await dm_channel.send(embed=embed)
+        guild_message = await message_ops.send_message(guild_channel, embed=embed)
 
         # Save the vacation in the database
-        # Save vacation in database
-        save_data('vacations', 'user_id, start_date, end_date, reason, issuer, message_id',
-                  (int(nutzer.id),
-                   start_date_datetime.timestamp(),
-                   end_date_datetime.timestamp(),
-                   grund,
-                   int(ctx.author.id),
-                   int(guild_message.id)))
+        vacation_id = await save_data('vacations', 'user_id, start_date, end_date, reason, issuer, message_id',
+                                      (int(nutzer.id),
+                                       start_date_datetime.timestamp(),
+                                       end_date_datetime.timestamp(),
+                                       grund,
+                                       int(ctx.author.id),
+                                       int(guild_message.id)))
+        deadlines.schedule("vacations", vacation_id,
+                           end_date_datetime.timestamp() + DEADLINE_OFFSETS["vacations"])
 
+        embed.fields.append(i.EmbedField(
+            name="Ersteller", value=ctx.author.display_name))
+        with request_scheduler.background():
+            failed = await message_ops.send_dms(self._getDMUsers(ctx), embed=embed)
+        if len(failed) > 0:
+            names = ", ".join(member.display_name for member in failed)
+            await ctx.send(f"Abwesenheit eingetragen! Nicht benachrichtigt werden konnten: {names}",
+                           ephemeral=True)
+            return
         await ctx.send("Abwesenheit eingetragen!", ephemeral=True, delete_after=10)
@@ -1,8 +1,9 @@
 import configparser as cp
 from random import randint
 from time import time
-import classes.database as db
-import sqlite3 as sql
+import classes.async_database as db
+from classes import autocomplete
+from classes.database import Transaction
 from classes.voting import Voting
 
 import interactions as i
@@ -25,13 +26,6 @@ class VotingCommand(i.Extension):
             global scope_ids
             scope_ids = config.get('General', 'servers').split(',')
 
-    @staticmethod
-    def get_identifiers() -> list[int]:
-        con = sql.connect("data.db")
-        cur = con.cursor()
-        cur.execute("SELECT voting_id FROM votings")
-        return [int(ident[0]) for ident in cur.fetchall()]
-
     @i.slash_command(
         name="abstimmung",
         description="Der Befehl für Abstimmungen.",
@@ -60,10 +54,17 @@ class VotingCommand(i.Extension):
                         value="close"
                     )
                 ]
+            ),
+            i.SlashCommandOption(
+                name="id",
+                description="Die Abstimmung, die du löschen, bearbeiten oder beenden willst.",
+                type=i.OptionType.STRING,
+                required=False,
+                autocomplete=True
             )
         ]
     )
-    async def votings(self, ctx: i.SlashContext, aktion: str):
+    async def votings(self, ctx: i.SlashContext, aktion: str, id: str = None):
         if aktion == "create":
             sentences = [
                 "Ist Ketchup ein Smoothie?",
@@ -105,12 +106,28 @@ class VotingCommand(i.Extension):
                 *components
             )
             await ctx.send_modal(create_voting_modal)
+        elif id:
+            voting = await self.get_own_voting(ctx, id)
+            if voting is None:
+                return
+            if aktion == "edit":
+                await self.send_edit_modal(ctx, voting)
+                return
+            await ctx.defer(ephemeral=True)
+            if aktion == "delete":
+                await voting.delete()
+                await ctx.send("Die Abstimmung wurde gelöscht.", ephemeral=True,
+                               delete_after=5)
+            elif aktion == "close":
+                await voting.close()
+                await ctx.send("Die Abstimmung wurde beendet.", ephemeral=True,
+                               delete_after=5)
         elif aktion == "delete":
             options = []
-            if db.get_data("votings", {"user_id": int(ctx.author.id)}, fetch_all=True) == []:
+            if await db.get_data("votings", {"user_id": int(ctx.author.id)}, fetch_all=True) == []:
                 await ctx.send("Es existieren keine Abstimmungen!")
                 return
-            votings: list[tuple] = db.get_data(
+            votings: list[tuple] = await db.get_data(
                 "votings", {"user_id": int(ctx.author.id)}, attribute="voting_id", fetch_all=True)
             for voting_tuple in votings:
                 options.append(
@@ -119,15 +136,11 @@ class VotingCommand(i.Extension):
                         value=voting_tuple[0]
                     )
                 )
-            delete_selectmenu = i.StringSelectMenu(
-                custom_id="delete_voting_menu",
-                placeholder="Wähle eine Abstimmung aus",
-                *options
-            )
-            await ctx.send("Wähle eine Abstimmung aus, die du löschen möchtest.", components=delete_selectmenu,
-                           ephemeral=True, delete_after=90)
+            await autocomplete.send_select_menu(ctx, "delete_voting_menu", options,
+                                                "Wähle eine Abstimmung aus", delete_after=90,
+                                                content="Wähle eine Abstimmung aus, die du löschen möchtest.")
         elif aktion == "edit":
-            votings = db.get_data(
+            votings = await db.get_data(
                 "votings", {"user_id": int(ctx.author.id)}, attribute="voting_id", fetch_all=True)
             if votings == []:
                 await ctx.send("Es existieren keine Abstimmungen!")
@@ -140,20 +153,16 @@ class VotingCommand(i.Extension):
                         value=voting_tuple[0]
                     )
                 )
-            edit_selectmenu = i.StringSelectMenu(
-                custom_id="edit_voting_menu",
-                placeholder="Wähle eine Abstimmung aus",
-                *options
-            )
-            await ctx.send("Wähle eine Abstimmung aus, die du bearbeiten möchtest.", components=edit_selectmenu,
-                           ephemeral=True, delete_after=90)
+            await autocomplete.send_select_menu(ctx, "edit_voting_menu", options,
+                                                "Wähle eine Abstimmung aus", delete_after=90,
+                                                content="Wähle eine Abstimmung aus, die du bearbeiten möchtest.")
         elif aktion == "close":
             options = []
-            if db.get_data("votings", {"user_id": int(ctx.author.id)}, fetch_all=True) == []:
+            if await db.get_data("votings", {"user_id": int(ctx.author.id)}, fetch_all=True) == []:
                 await ctx.send("Es existieren keine Abstimmungen!", ephemeral=True,
                                delete_after=5)
                 return
-            votings: list[tuple] = db.get_data(
+            votings: list[tuple] = await db.get_data(
                 "votings", {"user_id": int(ctx.author.id)}, attribute="voting_id", fetch_all=True)
             for voting_tuple in votings:
                 options.append(
@@ -162,14 +171,26 @@ class VotingCommand(i.Extension):
                         value=voting_tuple[0]
                     )
                 )
-            close_menu = i.StringSelectMenu(
-                custom_id="close_voting_menu",
-                placeholder="Wähle eine Abstimmung aus",
-                *options,
-                max_values=len(options)
-            )
-            await ctx.send("Wähle eine Abstimmung aus, die du beenden möchtest.", components=close_menu,
-                           ephemeral=True, delete_after=90)
+            await autocomplete.send_select_menu(ctx, "close_voting_menu", options,
+                                                "Wähle eine Abstimmung aus", multiple=True, delete_after=90,
+                                                content="Wähle eine Abstimmung aus, die du beenden möchtest.")
+
+    @votings.autocomplete("id")
+    async def voting_id_autocomplete(self, ctx: i.AutocompleteContext):
+        await autocomplete.send_choices(ctx, "votings", owner=int(ctx.author.id))
+
+    async def get_own_voting(self, ctx: i.SlashContext, voting_id: str) -> Voting | None:
+        """Returns the voting if it exists and the author owns it, else tells them why not."""
+        try:
+            voting = await Voting.load(int(voting_id), self.client)
+        except ValueError:
+            await ctx.send("Diese Abstimmung gibt es nicht.", ephemeral=True, delete_after=5)
+            return None
+        if voting.owner != int(ctx.author.id):
+            await ctx.send("Du kannst nur deine eigenen Abstimmungen verwalten!", ephemeral=True,
+                           delete_after=5)
+            return None
+        return voting
 
     @i.modal_callback("mod_create_voting")
     async def create_voting_response(self, ctx: i.ModalContext, text: str, count: str, deadline: str):
@@ -202,10 +223,7 @@ class VotingCommand(i.Extension):
             return
         await ctx.defer(ephemeral=True)
         deadline_in_seconds = float(deadline) * time_in_seconds
-        identifier = randint(1000, 9999)
-        identifiers = self.get_identifiers()
-        while identifier in identifiers:
-            identifier = randint(1000, 9999)
+        identifier = await db.allocate_id("votings")
         end_time = time() + deadline_in_seconds
         voting = Voting(identifier, self.client,
                         owner=ctx.author.id,
@@ -214,8 +232,7 @@ class VotingCommand(i.Extension):
                         wait_time=deadline_in_seconds,
                         create_time=time(),
                         time_type=time_type,
-                        count=count,
-                        skip_setup=True
+                        count=count
                         )
         await voting.create()
         await ctx.send("Die Abstimmung wurde entgegen genommen.", ephemeral=True,
@@ -223,9 +240,12 @@ class VotingCommand(i.Extension):
 
     @i.component_callback("edit_voting_menu")
     async def edit_voting_response(self, ctx: i.ComponentContext):
-        id = ctx.values[0]
-        self.transfer_data[int(ctx.author.id)] = id
-        voting = Voting(id, self.client)
+        voting = await Voting.load(ctx.values[0], self.client)
+        await self.send_edit_modal(ctx, voting)
+
+    async def send_edit_modal(self, ctx: i.InteractionContext, voting: Voting) -> None:
+        """Sends the modal to edit the description of the voting."""
+        self.transfer_data[int(ctx.author.id)] = voting.id
         edit_modal = i.Modal(
             i.InputText(
                 style=i.TextStyles.PARAGRAPH,
@@ -243,7 +263,7 @@ class VotingCommand(i.Extension):
     async def edit_voting(self, ctx: i.ModalContext, text: str):
         await ctx.defer(ephemeral=True)
         id = self.transfer_data[int(ctx.author.id)]
-        voting = Voting(id, self.client)
+        voting = await Voting.load(id, self.client)
         voting.description = text
         await voting.update()
         await ctx.send("Die Abstimmung wurde bearbeitet.", ephemeral=True,
@@ -252,7 +272,7 @@ class VotingCommand(i.Extension):
     @i.component_callback("delete_voting_menu")
     async def delete_voting(self, ctx: i.ComponentContext):
         id = ctx.values[0]
-        voting = Voting(id, self.client)
+        voting = await Voting.load(id, self.client)
         await voting.delete()
         await ctx.send("Die Abstimmung wurde gelöscht.", ephemeral=True,
                        delete_after=5)
@@ -260,7 +280,22 @@ class VotingCommand(i.Extension):
     @i.component_callback("close_voting_menu")
     async def close_voting(self, ctx: i.ComponentContext):
         await ctx.defer(ephemeral=True)
-        for id in ctx.values:
-            voting = Voting(id, self.client)
-            await voting.close()
+        votings = await Voting.load_all(self.client, {"voting_id": [int(id) for id in ctx.values]})
+        failed = []
+        async with db.transaction() as batch:
+            for voting in votings:
+                # Only the writes of votings that were closed on Discord go into the batch
+                voting_batch = Transaction()
+                try:
+                    await voting.close(voting_batch)
+                except Exception as e:
+                    print(f"Closing voting {voting.id} failed: {e!r}")
+                    failed.append(voting.id)
+                    continue
+                batch.merge(voting_batch)
+        if len(failed) > 0:
+            await ctx.edit(content=f"Diese Abstimmungen konnten nicht beendet werden: "
+                           f"{', '.join(map(str, failed))}. Bitte versuche es später erneut.",
+                           components=[])
+            return
         await ctx.edit(content="Die Abstimmungen wurden beendet.", components=[])
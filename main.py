@@ -1,13 +1,15 @@
 import asyncio
 import configparser as cp
 import pkgutil
-from datetime import date
-from functools import partial
+from datetime import date, timedelta
 from time import mktime, strftime, strptime, time
 
 import interactions as i
 
-import classes.database as db
+import classes.async_database as db
+from classes import message_ops
+from classes.deadline_scheduler import deadlines
+from classes.user_directory import directory
 from classes.voting import Voting
 
 db.setup()
@@ -40,101 +42,119 @@ extension_names = [m.name for m in pkgutil.iter_modules(
     ["cmds"], prefix="cmds.")]
 for extension in extension_names:
     bot.load_extension(extension)
-votings_timer_started: set = set()
 
 
-async def automatic_delete(oneshot: bool = False) -> None:
-    if not oneshot:
-        asyncio.get_running_loop().call_later(86400, run_delete)
+async def expire_messages(kind: str, table: str, id_column: str, channel_id: int, ids: list[int]) -> None:
+    """Deletes the messages of the expired items and then their rows. Items whose message
+    couldn't be deleted are kept and retried later."""
+    rows = await db.get_data(table, {id_column: ids},
+                             attribute=f"{id_column}, message_id", fetch_all=True)
+    if len(rows) == 0:
+        return
+    failed = await message_ops.delete_messages(bot, channel_id,
+                                               [message_id for _, message_id in rows])
+    for id, message_id in rows:
+        if int(message_id) in failed:
+            await deadlines.record_failure(kind, id, failed[int(message_id)])
+    done = [id for id, message_id in rows if int(message_id) not in failed]
+    if len(done) > 0:
+        async with db.transaction() as batch:
+            batch.delete(table, {id_column: done})
+        await deadlines.record_success(kind, done)
+
+
+async def expire_offers(offer_ids: list[int]) -> None:
+    await expire_messages("offers", "offers", "offer_id", offer_channel_id, offer_ids)
+
+
+async def expire_votings(voting_ids: list[int]) -> None:
+    votings = {voting.id: voting for voting in await Voting.load_all(bot, {"voting_id": voting_ids})}
+    await deadlines.expire_each("votings", list(votings), lambda id: votings[id].close())
+
+
+async def expire_vacations(vacation_ids: list[int]) -> None:
+    await expire_messages("vacations", "vacations", "ID", vacation_channel_id, vacation_ids)
+
+
+# Everything is expired by the deadline scheduler at its deadline. The daily sweep at
+# 23:59 is only a safety net for anything it missed, it goes through the scheduler too,
+# so it skips what's being expired right now.
+async def automatic_delete() -> None:
     current_time = time()
 
     async def clean_offers(current_time):
-        offer_channel: i.GuildText = await bot.fetch_channel(offer_channel_id)
-        if offer_channel is None:
-            print("The offer channel has not been found! Please check the config!")
-            return
-        offers = db.get_data(
-            "offers", attribute="deadline, message_id, offer_id, user_id", fetch_all=True)
-        for deadline, message_id, offer_id, user_id in offers:
-            if deadline <= current_time:
-                try:
-                    message = await offer_channel.fetch_message(message_id)
-                    if message is not None:
-                        await message.delete()
-                except TypeError:
-                    continue
-                db.delete_data("offers", {"offer_id": offer_id})
-                offer_count = db.get_data("users", {"user_id": user_id})[1]
-                db.update_data("users", "offers_count", offer_count - 1, {
-                    "user_id": user_id})
+        expired = await db.get_due("offers", "offer_id", "deadline", current_time)
+        if len(expired) > 0:
+            await deadlines.expire("offers", [offer_id for offer_id, _ in expired])
 
     async def clean_votings(current_time):
-        votings = db.get_data(
-            "votings", attribute="voting_id", fetch_all=True)
-        for voting_data in votings:
-            voting_id = voting_data[0]
-            voting = Voting(voting_id, bot)
-            if voting.deadline <= int(current_time):
-                await voting.close()
+        expired = await db.get_due("votings", "voting_id", "deadline", int(current_time))
+        if len(expired) > 0:
+            await deadlines.expire("votings", [voting_id for voting_id, _ in expired])
 
     async def clean_vactions():
-        vacations = db.get_data(
-            "vacations", attribute="ID, end_date, message_id", fetch_all=True)
-        for id, end_date, message_id in vacations:
-            current_date = date.today()
-            end_date = date.fromtimestamp(end_date)
-            delta = end_date - current_date
-            if delta.days <= 0:
-                vacation_channel = await bot.fetch_channel(vacation_channel_id)
-                if vacation_channel is None:
-                    print(
-                        "The vacation channel has not been found! Please check the config!")
-                    return
-                try:
-                    message = await vacation_channel.fetch_message(message_id)
-                    if message is not None:
-                        await message.delete()
-                except TypeError:
-                    continue
-                db.delete_data("vacations", {"ID": id})
-
-    await clean_offers(current_time)
-    await clean_votings(current_time)
-    await clean_vactions()
-
-
-def run_delete(oneshot: bool = False):
-    asyncio.get_running_loop().create_task(automatic_delete(oneshot=oneshot))
-
-
-# Make task that checks the votings table for new votings to start a delete timer
-# Go trough all the votings
-# Call asyncio.get_running_loop().call_later(wait_time - (localtime - create time), run_delete, oneshot=True)
-# Add voting ID to list so there's no duplicate timers
-# The +2 on the wait time is to mitigate a problem with the computer being too fast
-async def check_votings():
-    while True:
-        votings = db.get_data(
-            "votings", attribute="voting_id", fetch_all=True)
-        for voting_data in votings:
-            voting = Voting(voting_data[0], bot)
-            if voting.id not in votings_timer_started:
-                asyncio.get_running_loop().call_later(
-                    voting.wait_time - (time() - voting.create_time) + 2, partial(run_delete, oneshot=True))
-                votings_timer_started.add(voting.id)
-        await asyncio.sleep(30)
+        # Every vacation ending today or earlier, i.e. before tomorrow
+        tomorrow = mktime((date.today() + timedelta(days=1)).timetuple())
+        expired = await db.get_due("vacations", "ID", "end_date", tomorrow - 1)
+        if len(expired) > 0:
+            await deadlines.expire("vacations", [id for id, _ in expired])
+
+    # Each runs on its own, so one failing or being slow doesn't stop the others
+    results = await asyncio.gather(clean_offers(current_time), clean_votings(current_time),
+                                   clean_vactions(), return_exceptions=True)
+    for name, result in zip(("offers", "votings", "vacations"), results):
+        if isinstance(result, Exception):
+            print(f"Cleaning the {name} failed: {result!r}")
+
+
+def get_next_sweep_time() -> float:
+    """Returns the time of the next daily sweep (23:59)."""
+    sweep_time = mktime(strptime(strftime("%d.%m.%Y") + " 23:59", "%d.%m.%Y %H:%M"))
+    if sweep_time <= time():
+        sweep_time += 86400
+    return sweep_time
+
+
+async def daily_sweep(_) -> None:
+    deadlines.schedule("sweep", 0, get_next_sweep_time())
+    await automatic_delete()
+
+
+deadlines.register("offers", expire_offers)
+deadlines.register("votings", expire_votings)
+deadlines.register("vacations", expire_vacations)
+deadlines.register("sweep", daily_sweep)
 
 
 @i.listen()
 async def on_ready():
     print("Bot is ready!")
+    directory.warm(bot)
     global run
     if not run:
-        wait_time = mktime(strptime(strftime("%d.%m.%Y") +
-                           " 23:59", "%d.%m.%Y %H:%M")) - time()
-        asyncio.get_running_loop().call_later(wait_time, run_delete)
-        asyncio.get_running_loop().create_task(check_votings())
         run = True
+        # What got due while the bot was offline is expired first. Both use the same
+        # time, what gets due during the catch up is loaded and expired right after.
+        now = time()
+        await deadlines.catch_up(now)
+        await deadlines.load(now)
+        deadlines.schedule("sweep", 0, get_next_sweep_time())
+        deadlines.start()
+
+
+@i.listen()
+async def on_member_add(event: i.events.MemberAdd):
+    directory.remember(event.member)
+
+
+@i.listen()
+async def on_member_update(event: i.events.MemberUpdate):
+    directory.remember(event.after)
+
+
+@i.listen()
+async def on_member_remove(event: i.events.MemberRemove):
+    directory.forget(event.member.id)
 
 
 @i.slash_command(
@@ -145,3 +165,4 @@ async def test(ctx: i.SlashContext):
     await ctx.send("Test worked!")
 
 bot.start()
+db.shutdown()